@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# conntrack.py: Benchmark for the connections view refresh
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time one refresh: split-and-rebuild vs. get_connections/sync_keyed_model.
+
+Uses synthetic conntrack files (by default 200k lines of TCP, UDP and ICMP
+flows), the second of which has about 1% of the flows replaced. Also times
+each parser alone, and the grouping of the connections for the aggregated
+view.
+
+Uses a real gtk.TreeStore when PyGTK is available. Otherwise a dict with the
+same interface stands in for it, which makes adding rows nearly free. Then
+rebuild and sync only measure parsing and diffing, and no speedup is
+reported.
+"""
+
+import itertools
+import os
+import os.path
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from gfw.aggregate import group_connections
+from gfw.util import get_connections, diff_keys, sync_keyed_model
+
+try:
+    import gtk
+except ImportError:
+    gtk = None
+
+
+class TreeModel(dict):
+
+    def __init__(self):
+        super(TreeModel, self).__init__()
+        self._ids = itertools.count()
+
+    def append(self, parent, row):
+        itr = next(self._ids)
+        self[itr] = row
+        return itr
+
+    def remove(self, itr):
+        del self[itr]
+
+
+def make_model():
+    if gtk is None:
+        return TreeModel()
+    return gtk.TreeStore(str, str, str, str, str)
+
+
+TEMPLATES = [
+    'ipv4     2 tcp      6 431999 ESTABLISHED src=10.0.%d.%d dst=192.0.2.1 '
+    'sport=%d dport=%d src=192.0.2.1 dst=10.0.%d.%d sport=%d dport=%d '
+    '[ASSURED] mark=0 zone=0 use=2\n',
+    'ipv4     2 udp      17 29 src=10.1.%d.%d dst=192.0.2.53 sport=%d '
+    'dport=%d [UNREPLIED] src=192.0.2.53 dst=10.1.%d.%d sport=%d dport=%d '
+    'mark=0 zone=0 use=2\n',
+    'ipv4     2 tcp      6 117 TIME_WAIT src=10.2.%d.%d dst=192.0.2.1 '
+    'sport=%d dport=%d src=192.0.2.1 dst=10.2.%d.%d sport=%d dport=%d '
+    '[ASSURED] mark=0 zone=0 use=2\n',
+]
+ICMP = ('ipv4     2 icmp     1 29 src=10.3.%d.%d dst=192.0.2.1 type=8 '
+        'code=0 id=%d src=192.0.2.1 dst=10.3.%d.%d type=0 code=0 id=%d '
+        'mark=0 zone=0 use=2\n')
+
+
+def make_conntrack(path, lines, offset=0):
+    with open(path, 'w') as f:
+        for i in xrange(offset, offset + lines):
+            a, b = (i // 254) % 256, i % 254 + 1
+            sport, dport = 1024 + i % 60000, 1 + i % 1024
+            if i % 10 == 9:
+                f.write(ICMP % (a, b, i, a, b, i))
+            else:
+                t = TEMPLATES[i % len(TEMPLATES)]
+                f.write(t % (a, b, sport, dport, a, b, dport, sport))
+
+
+def legacy_get_connections(path, append):
+    """The parser used before gfw.util.get_connections"""
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split()
+            if line[2] != 'udp' and line[5] != 'ESTABLISHED':
+                continue
+            proto = line[2].upper()
+            s = 5
+            if line[2] == 'tcp':
+                s += 1
+            src = line[s].partition('=')[2]
+            dst = line[s + 1].partition('=')[2]
+            sport = line[s + 2].partition('=')[2]
+            dport = line[s + 3].partition('=')[2]
+            append((proto, src, sport, dst, dport))
+
+
+def bench_parse(path):
+    start = time.time()
+    legacy_get_connections(path, lambda row: None)
+    t_legacy = time.time() - start
+    start = time.time()
+    for conn in get_connections(path):
+        pass
+    return t_legacy, time.time() - start
+
+
+def bench_rebuild(model, path):
+    start = time.time()
+    model.clear()
+    legacy_get_connections(path, lambda row: model.append(None, row))
+    return time.time() - start
+
+
+def bench_sync(model, iters, path):
+    start = time.time()
+    conns = {}
+    for conn in get_connections(path):
+        conns[conn] = conn
+    diff = diff_keys(iters, conns)
+    sync_keyed_model(model, iters, conns, diff)
+    return time.time() - start, len(diff[0]) + len(diff[1])
+
+
+def bench_group(path):
+    start = time.time()
+    groups = group_connections(get_connections(path))
+    return time.time() - start, len(groups)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--lines', type='int', default=200000,
+                      help='number of lines of the synthetic conntrack files')
+    options, args = parser.parse_args()
+    paths = []
+    for i in xrange(2):
+        fd, path = tempfile.mkstemp(suffix='.conntrack')
+        os.close(fd)
+        paths.append(path)
+    try:
+        make_conntrack(paths[0], options.lines)
+        make_conntrack(paths[1], options.lines, options.lines // 100)
+        model = make_model()
+        bench_rebuild(model, paths[0])
+        t_rebuild = bench_rebuild(model, paths[1])
+        n_rebuild = len(model)
+        model = make_model()
+        iters = {}
+        t_fill, n_fill = bench_sync(model, iters, paths[0])
+        t_sync, n_sync = bench_sync(model, iters, paths[1])
+        t_group, n_group = bench_group(paths[1])
+        t_legacy, t_parse = bench_parse(paths[1])
+    finally:
+        for path in paths:
+            os.remove(path)
+    print('model: %s' % ('gtk.TreeStore' if gtk is not None else 'dict'))
+    print('%-8s %10s %10s %10s' % ('method', 'seconds', 'rows', 'changed'))
+    print('%-8s %10.3f %10d %10d' % ('rebuild', t_rebuild, n_rebuild,
+                                     n_rebuild))
+    print('%-8s %10.3f %10d %10d' % ('fill', t_fill, len(iters), n_fill))
+    print('%-8s %10.3f %10d %10d' % ('sync', t_sync, len(iters), n_sync))
+    print('%-8s %10.3f %10d' % ('group', t_group, n_group))
+    print('parse: %.3fs legacy, %.3fs get_connections' % (t_legacy, t_parse))
+    if gtk is not None:
+        print('speedup: %.2fx' % (t_rebuild / t_sync))
+    else:
+        print('speedup: not measured without a gtk.TreeStore')
+
+
+if __name__ == '__main__':
+    main()
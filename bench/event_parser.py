@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# event_parser.py: Benchmark for the ufw log parser
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare gfw.event.parse with the previous findall/split/dict parser.
+
+Replays a log file (by default a synthetic one of 1M lines, of which about
+half are BLOCK events) through both parsers.
+"""
+
+import os
+import os.path
+import re
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from gfw.event import parse
+
+
+_re_keyval = re.compile(r'([A-Z]+)=([^ ]*)')
+_re_event = re.compile(r'\[UFW ([A-Z ]+)\]')
+
+
+def legacy_parse(data):
+    """The parser used before gfw.event.parse"""
+    try:
+        event = _re_event.findall(data)[0]
+    except IndexError:
+        return
+    if 'BLOCK' not in event:
+        return
+    timestamp = ' '.join(data.split()[:3])
+    conn = dict(_re_keyval.findall(data))
+    return (timestamp, event, conn)
+
+
+TEMPLATES = [
+    'Oct 18 10:%02d:%02d gw kernel: [8812.%06d] [UFW BLOCK] IN=eth0 OUT= '
+    'MAC=00:16:3e:00:00:01:00:16:3e:00:00:02:08:00 SRC=203.0.113.%d '
+    'DST=192.0.2.1 LEN=40 TOS=0x00 PREC=0x00 TTL=241 ID=54321 PROTO=TCP '
+    'SPT=%d DPT=%d WINDOW=1024 RES=0x00 SYN URGP=0\n',
+    'Oct 18 10:%02d:%02d gw kernel: [8812.%06d] [UFW LIMIT BLOCK] IN=eth0 '
+    'OUT= MAC=00:16:3e:00:00:01:00:16:3e:00:00:02:08:00 SRC=198.51.100.%d '
+    'DST=192.0.2.1 LEN=60 TOS=0x00 PREC=0x00 TTL=52 ID=1 DF PROTO=UDP '
+    'SPT=%d DPT=%d LEN=40\n',
+    'Oct 18 10:%02d:%02d gw kernel: [8812.%06d] [UFW AUDIT] IN= OUT=eth0 '
+    'SRC=192.0.2.1 DST=203.0.113.%d LEN=52 TOS=0x00 PREC=0x00 TTL=64 '
+    'ID=0 DF PROTO=TCP SPT=%d DPT=%d WINDOW=229 RES=0x00 ACK URGP=0\n',
+    'Oct 18 10:%02d:%02d gw kernel: [8812.%06d] [UFW ALLOW] IN=eth0 OUT= '
+    'MAC=00:16:3e:00:00:01:00:16:3e:00:00:02:08:00 SRC=203.0.113.%d '
+    'DST=192.0.2.1 LEN=60 TOS=0x00 PREC=0x00 TTL=57 ID=0 DF PROTO=TCP '
+    'SPT=%d DPT=%d WINDOW=29200 RES=0x00 SYN URGP=0\n',
+]
+
+
+def make_log(path, lines):
+    with open(path, 'w') as f:
+        for i in xrange(lines):
+            t = TEMPLATES[i % len(TEMPLATES)]
+            f.write(t % ((i // 60) % 60, i % 60, i % 1000000, i % 254 + 1,
+                         1024 + i % 60000, 1 + i % 1024))
+
+
+def run(path, func):
+    count = 0
+    start = time.time()
+    with open(path, 'r') as f:
+        for line in f:
+            if func(line) is not None:
+                count += 1
+    return time.time() - start, count
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-l', '--log', help='replay this log instead')
+    parser.add_option('-n', '--lines', type='int', default=1000000,
+                      help='number of lines of the synthetic log')
+    options, args = parser.parse_args()
+    path = options.log
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        make_log(path, options.lines)
+    try:
+        # Warm up the page cache
+        run(path, lambda line: None)
+        t_old, n_old = run(path, legacy_parse)
+        t_new, n_new = run(path, parse)
+    finally:
+        if options.log is None:
+            os.remove(path)
+    print('%-8s %10s %10s' % ('parser', 'seconds', 'events'))
+    print('%-8s %10.3f %10d' % ('legacy', t_old, n_old))
+    print('%-8s %10.3f %10d' % ('compiled', t_new, n_new))
+    print('speedup: %.2fx' % (t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
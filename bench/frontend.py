@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# frontend.py: Benchmark for the Frontend hot paths
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time and peak memory of the Frontend operations on synthetic rulesets.
+
+The rules are held by a stub of ufw's iptables backend which never reads or
+writes the rules files or runs iptables, so this runs without root. Every
+10th rule is for an app, every 4th of the others is IPv6 and every 3rd of
+the rest is for a range of ports.
+
+Each operation runs in a forked process, so that the peak memory reported
+(the growth of the maximum resident set size while it runs) is its own.
+_update_rules_model is only measured when PyGTK and a display are
+available, and without the analysis of the rules, which the application
+runs on its worker thread and which is measured as analyze. Results can be
+saved as JSON with --output, and compared with those of an earlier run with
+--compare.
+"""
+
+import json
+import os
+import os.path
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+import ufw.backend_iptables
+import ufw.frontend
+from ufw.common import UFWRule
+
+from gfw.analyze import analyze
+from gfw.frontend import Frontend
+from gfw.l10n import ufw_localize
+from gfw.util import get_formatted_rule, get_ui_path
+
+try:
+    import gtk
+    from gfw.frontend_gtk import Builder, GtkFrontend
+except (ImportError, RuntimeError):
+    gtk = None
+
+
+SIZES = (100, 1000, 10000, 50000)
+OPERATIONS = ('get_rules', '_get_command', 'get_formatted_rule',
+              'export_rules', 'import_rules', 'analyze',
+              '_update_rules_model')
+# ufw's backend compares each rule it adds with all the existing ones, so
+# imports take quadratic time and are skipped for larger rulesets
+IMPORT_MAX_RULES = 1000
+APPS = 20
+
+
+class StubBackend(ufw.backend_iptables.UFWBackendIptables):
+    """ufw's iptables backend without any files or iptables commands"""
+
+    def __init__(self, *args, **kwargs):
+        self.name = 'iptables'
+        self.dryrun = True
+        self.defaults = {'ipv6': 'yes', 'enabled': 'no'}
+        self.files = {}
+        self.rules = []
+        self.rules6 = []
+        self.profiles = {}
+        for i in xrange(APPS):
+            name = 'App%d' % (i, )
+            self.profiles[name] = {'title': name, 'description': name,
+                                   'ports': '%d/tcp' % (8000 + i, )}
+        self.iptables = 'iptables'
+        self.ip6tables = 'ip6tables'
+        self.iptables_version = '1.4.21'
+        self.caps = {'limit': {'4': True, '6': True}}
+
+    def use_ipv6(self):
+        return True
+
+    def _is_enabled(self):
+        return False
+
+    def _write_rules(self, v6=False):
+        pass
+
+
+# Frontend creates its backend through ufw.frontend
+ufw.frontend.UFWBackendIptables = StubBackend
+
+
+def make_rule(i):
+    action = ('allow', 'deny', 'reject')[i % 3]
+    net = '10.%d.%d.0/24' % (i // 256 % 256, i % 256)
+    if i % 10 == 0:
+        app = i // 10 % APPS
+        rule = UFWRule(action, 'tcp', str(8000 + app), src=net)
+        rule.dapp = 'App%d' % (app, )
+    elif i % 4 == 1:
+        net = '2001:db8:%x:%x::/64' % (i >> 16, i & 0xffff)
+        rule = UFWRule(action, 'udp', str(1 + i % 65535), '::/0', src=net)
+        rule.set_v6(True)
+    elif i % 3 == 2:
+        first = 1024 + i % 60000
+        ports = '%d:%d' % (first, first + 10)
+        rule = UFWRule(action, 'tcp', ports, src=net)
+    else:
+        rule = UFWRule(action, 'tcp', str(1 + i % 65535), src=net)
+    return rule
+
+
+def add_rules(frontend, n):
+    backend = frontend.backend
+    for i in xrange(n):
+        rule = make_rule(i)
+        if rule.v6:
+            backend.rules6.append(rule)
+        else:
+            backend.rules.append(rule)
+    return frontend
+
+
+def make_rules_view():
+    """Returns a GtkFrontend with only its rules view set up"""
+    view = GtkFrontend.__new__(GtkFrontend)
+    Frontend.__init__(view)
+    view.ui = Builder()
+    view.ui.add_from_file(get_ui_path(GtkFrontend.UI_FILE))
+    view._selection = view.ui.rules_view.get_selection()
+    view._selection.set_mode(gtk.SELECTION_MULTIPLE)
+    view._rules_rows = []
+    view._rules_index = None
+    view._rules_visible = None
+    view._counters = {}
+    view._counters_generation = None
+    view._analysis = {}
+    view._analysis_generation = None
+    view._analysis_pending = None
+    # There is no worker to run it on; analyze is measured on its own
+    view._refresh_analysis = lambda: None
+    view.ui.rules_filter.set_visible_func(view._is_rule_visible)
+    return view
+
+
+def setup_get_rules(n, tmpdir):
+    frontend = add_rules(Frontend(), n)
+    def run():
+        # Bypass the cache
+        frontend.generation += 1
+        frontend.get_rules()
+    return run
+
+
+def setup_get_command(n, tmpdir):
+    rules = [r for i, r in add_rules(Frontend(), n).get_rules()]
+    def run():
+        for r in rules:
+            Frontend._get_command(r)
+    return run
+
+
+def setup_get_formatted_rule(n, tmpdir):
+    rules = [r for i, r in add_rules(Frontend(), n).get_rules()]
+    def run():
+        for r in rules:
+            get_formatted_rule(r)
+    return run
+
+
+def setup_export_rules(n, tmpdir):
+    frontend = add_rules(Frontend(), n)
+    path = os.path.join(tmpdir, 'export.sh')
+    return lambda: frontend.export_rules(path)
+
+
+def setup_import_rules(n, tmpdir):
+    path = os.path.join(tmpdir, 'import.sh')
+    add_rules(Frontend(), n).export_rules(path)
+    return lambda: Frontend().import_rules(path)
+
+
+def setup_analyze(n, tmpdir):
+    rules = [r for i, r in add_rules(Frontend(), n).get_rules()]
+    return lambda: analyze(rules)
+
+
+def setup_update_rules_model(n, tmpdir):
+    view = add_rules(make_rules_view(), n)
+    def run():
+        # Fill the view from scratch every time
+        view._rules_rows = []
+        view.ui.rules_model.clear()
+        view.generation += 1
+        view._update_rules_model()
+    return run
+
+
+SETUPS = {
+    'get_rules': setup_get_rules,
+    '_get_command': setup_get_command,
+    'get_formatted_rule': setup_get_formatted_rule,
+    'export_rules': setup_export_rules,
+    'import_rules': setup_import_rules,
+    'analyze': setup_analyze,
+    '_update_rules_model': setup_update_rules_model,
+}
+
+
+def get_skip_reason(operation, n, import_max):
+    if operation == 'import_rules' and n > import_max:
+        return 'more than %d rules' % (import_max, )
+    if operation == '_update_rules_model':
+        if gtk is None:
+            return 'no PyGTK'
+        if gtk.gdk.display_get_default() is None:
+            return 'no display'
+    return None
+
+
+def get_peak_rss():
+    """Returns the maximum resident set size of this process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on Mac OS X, KiB on Linux
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def measure(operation, n, repeat, tmpdir):
+    run = SETUPS[operation](n, tmpdir)
+    base = get_peak_rss()
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return {
+        'operation': operation,
+        'rules': n,
+        'min': min(times),
+        'mean': sum(times) / len(times),
+        'peak_kib': get_peak_rss() - base,
+    }
+
+
+def measure_forked(operation, n, repeat, tmpdir):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            result = measure(operation, n, repeat, tmpdir)
+            os.write(w, json.dumps(result))
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        # Never return into the parent's code
+        os._exit(status)
+    os.close(w)
+    with os.fdopen(r, 'r') as f:
+        data = f.read()
+    status = os.waitpid(pid, 0)[1]
+    if status != 0 or not data:
+        return None
+    return json.loads(data)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    results = {}
+    for result in data['results']:
+        results[(result['operation'], result['rules'])] = result
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--sizes', default=','.join(str(n) for n in SIZES),
+                      help='comma-separated numbers of rules')
+    parser.add_option('--operations', default=','.join(OPERATIONS),
+                      help='comma-separated operations to measure')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each operation, of which the fastest '
+                           'and the mean are reported')
+    parser.add_option('--import-max', type='int', default=IMPORT_MAX_RULES,
+                      help='largest ruleset to import')
+    parser.add_option('--output', metavar='PATH',
+                      help='save the results as JSON')
+    parser.add_option('--compare', metavar='PATH',
+                      help='compare with the JSON results of an earlier run')
+    options, args = parser.parse_args()
+    sizes = [int(n) for n in options.sizes.split(',')]
+    operations = options.operations.split(',')
+    for operation in operations:
+        if operation not in SETUPS:
+            parser.error('unknown operation: %s' % (operation, ))
+    ufw_localize()
+    old = {}
+    if options.compare:
+        old = load_results(options.compare)
+    if options.output:
+        options.output = os.path.abspath(options.output)
+    # The UI file is found relative to the source tree
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.path.pardir))
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    print('%-20s %8s %12s %12s %10s %8s' % ('operation', 'rules', 'min ms',
+          'mean ms', 'peak KiB', 'change'))
+    try:
+        for operation in operations:
+            for n in sizes:
+                reason = get_skip_reason(operation, n, options.import_max)
+                if reason is None:
+                    result = measure_forked(operation, n, options.repeat,
+                                            tmpdir)
+                    if result is None:
+                        reason = 'failed'
+                if reason is not None:
+                    print('%-20s %8d skipped: %s' % (operation, n, reason))
+                    continue
+                results.append(result)
+                change = ''
+                if (operation, n) in old:
+                    before = old[(operation, n)]['min']
+                    if before > 0:
+                        ratio = result['min'] / before
+                        change = '%+.0f%%' % ((ratio - 1) * 100, )
+                print('%-20s %8d %12.2f %12.2f %10d %8s' % (operation, n,
+                      result['min'] * 1000, result['mean'] * 1000,
+                      result['peak_kib'], change))
+    finally:
+        shutil.rmtree(tmpdir)
+    if options.output:
+        data = {
+            'python': sys.version.split()[0],
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'repeat': options.repeat,
+            'results': results,
+        }
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+# log_rotation.py: Stress test for following the log across rotation
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Check that gfw.event.EventHandler neither loses nor repeats events while
+the log is rotated under a write load.
+
+A writer thread appends numbered BLOCK lines to a log in a temporary
+directory, in random bursts, while the log is rotated over and over:
+
+  * rename and create, as by logrotate's create: the writer keeps
+    appending to the renamed file until it is told to reopen the log
+  * copytruncate: the log is copied and truncated in place
+
+inotify is replaced by a stub WatchManager which turns changes of the
+watched files into events, delivered at random times and in random order,
+so this needs neither root nor a real log. Lines written between the copy
+and the truncation are lost by copytruncate itself, so the writer is held
+off meanwhile. A truncated log can only be told apart from a new one once
+something was read from it, so the log is only rotated again once events
+written since the last rotation were received. Exits with status 1 if any
+event is lost, repeated or out of order.
+"""
+
+import io
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from gfw.event import EventHandler
+
+
+LINE = ('Oct 18 10:00:00 gw kernel: [8812.000000] [UFW BLOCK] IN=eth0 OUT= '
+        'SRC=203.0.113.1 DST=192.0.2.1 LEN=40 PROTO=TCP SPT=%d DPT=22\n')
+
+
+class Event(object):
+
+    def __init__(self, wd, maskname, pathname):
+        self.wd = wd
+        self.maskname = maskname
+        self.pathname = pathname
+
+
+class WatchManager(object):
+    """Stands in for pyinotify.WatchManager
+
+    A watch on a file follows the file, not its path, as with inotify.
+    Modifications are found by comparing the size of the watched files at
+    each delivery, so consecutive ones are coalesced as inotify does.
+    """
+
+    def __init__(self):
+        self._next_wd = 1
+        # wd -> [path, fd, size] of the watched files
+        self.files = {}
+        self.queue = []
+
+    def add_watch(self, path, mask):
+        wd = self._next_wd
+        self._next_wd += 1
+        if not os.path.isdir(path):
+            fd = os.open(path, os.O_RDONLY)
+            self.files[wd] = [path, fd, os.fstat(fd).st_size]
+        return {path: wd}
+
+    def rm_watch(self, wd):
+        os.close(self.files.pop(wd)[1])
+
+    def watch_of(self, path):
+        ino = os.stat(path).st_ino
+        for wd, (p, fd, size) in self.files.iteritems():
+            if os.fstat(fd).st_ino == ino:
+                return wd
+        return None
+
+    def get_events(self):
+        events = self.queue
+        self.queue = []
+        for wd, w in self.files.iteritems():
+            size = os.fstat(w[1]).st_size
+            if size != w[2]:
+                w[2] = size
+                events.append(Event(wd, 'IN_MODIFY', w[0]))
+        random.shuffle(events)
+        return events
+
+    def close(self):
+        for wd in self.files.keys():
+            self.rm_watch(wd)
+
+
+class Writer(threading.Thread):
+    """Appends numbered lines to the log until stopped"""
+
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        # Held while the log is reopened or copied and truncated
+        self.lock = threading.Lock()
+        self.count = 0
+        self._done = threading.Event()
+        self._log = open(path, 'ab', 0)
+
+    def run(self):
+        while not self._done.is_set():
+            with self.lock:
+                for i in xrange(random.randint(1, 50)):
+                    self._log.write(LINE % (self.count, ))
+                    self.count += 1
+            time.sleep(random.random() * 0.001)
+        self._log.close()
+
+    def reopen(self):
+        with self.lock:
+            self._log.close()
+            self._log = open(self.path, 'ab', 0)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def deliver(wm, handler):
+    for event in wm.get_events():
+        # Events of files which are no longer watched are dropped
+        if event.wd in wm.files or event.maskname != 'IN_MODIFY':
+            getattr(handler, 'process_' + event.maskname)(event)
+
+
+def rotate_create(wm, handler, writer, path):
+    wd = wm.watch_of(path)
+    os.rename(path, path + '.1')
+    if wd is not None:
+        wm.queue.append(Event(wd, 'IN_MOVE_SELF', path))
+    deliver(wm, handler)
+    open(path, 'ab').close()
+    wm.queue.append(Event(None, 'IN_CREATE', path))
+    deliver(wm, handler)
+    # The writer keeps using the old file until it is told to reopen it
+    time.sleep(random.random() * 0.005)
+    deliver(wm, handler)
+    writer.reopen()
+
+
+def rotate_copytruncate(wm, handler, writer, path):
+    with writer.lock:
+        shutil.copyfile(path, path + '.1')
+        with open(path, 'r+b') as f:
+            f.truncate()
+
+
+def run(rotations, interval):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'ufw.log')
+    open(path, 'wb').close()
+    received = []
+    def callback(events, notify):
+        received.extend(int(e.spt) for e in events)
+    wm = WatchManager()
+    log = io.open(path, 'rb', 0)
+    handler = EventHandler(wm=wm, log=log, callback=callback, backfill=0,
+                           rotated=False)
+    writer = Writer(path)
+    writer.start()
+    try:
+        first = 0
+        for i in xrange(rotations):
+            end = time.time() + random.random() * interval
+            while time.time() < end or not received or received[-1] < first:
+                deliver(wm, handler)
+                time.sleep(random.random() * 0.002)
+            if i % 2:
+                rotate_copytruncate(wm, handler, writer, path)
+            else:
+                rotate_create(wm, handler, writer, path)
+            first = writer.count
+            deliver(wm, handler)
+        writer.stop()
+        deliver(wm, handler)
+    finally:
+        handler.close()
+        wm.close()
+        shutil.rmtree(tmpdir)
+    return writer.count, received
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--rotations', type='int', default=200,
+                      help='number of rotations')
+    parser.add_option('-i', '--interval', type='float', default=0.02,
+                      help='maximum time between rotations, in seconds')
+    parser.add_option('-s', '--seed', type='int',
+                      help='seed of the random timings')
+    options, args = parser.parse_args()
+    seed = options.seed
+    if seed is None:
+        seed = random.randint(0, sys.maxint)
+    random.seed(seed)
+    start = time.time()
+    written, received = run(options.rotations, options.interval)
+    seen = set(received)
+    lost = written - len(seen & set(xrange(written)))
+    repeated = len(received) - len(seen)
+    print('seed %d: %d rotations, %d lines written, %d received, %d lost, '
+          '%d repeated in %.1fs' % (seed, options.rotations, written,
+          len(received), lost, repeated, time.time() - start))
+    if lost or repeated or received != sorted(received):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
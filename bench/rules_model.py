@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# rules_model.py: Benchmark for updating the rules view model
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time per single-rule edit: clear-and-rebuild vs. diff_rows/sync_list_model.
+
+The rows have the columns of rules_model in share/ufw-gtk.ui, including the
+analysis and hit counter columns. With PyGTK, rules_model itself is loaded
+from the UI file. Without it, a plain list with the same interface stands
+in for it, which makes adding rows nearly free: then only the time of
+diff_rows and sync_list_model on the list is reported.
+"""
+
+import os
+import os.path
+import sys
+import time
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from gfw.util import diff_rows, get_formatted_size, get_ui_path, \
+                     sync_list_model
+
+try:
+    import gtk
+except ImportError:
+    gtk = None
+
+
+UI_FILE = 'ufw-gtk.ui'
+# Columns of the rule and its position, after which come those of the
+# analysis and the hit counters
+RULE_COLUMNS = 9
+
+
+class ListModel(list):
+
+    def get_iter(self, i):
+        return i
+
+    def remove(self, i):
+        del self[i]
+
+    def reorder(self, order):
+        self[:] = [self[i] for i in order]
+
+    def clear(self):
+        del self[:]
+
+
+def get_column_types():
+    """Returns the type names of the columns of rules_model"""
+    tree = ElementTree.parse(get_ui_path(UI_FILE))
+    for obj in tree.iter('object'):
+        if obj.get('id') == 'rules_model':
+            return [c.get('type') for c in obj.find('columns')]
+    raise ValueError('rules_model not found in %s' % (UI_FILE, ))
+
+
+def make_model():
+    if gtk is None:
+        return ListModel()
+    builder = gtk.Builder()
+    builder.add_objects_from_file(get_ui_path(UI_FILE), ['rules_model'])
+    return builder.get_object('rules_model')
+
+
+def make_row(i, action, proto, src, dport):
+    """Returns a row as GtkFrontend._update_rules_model makes it, with the
+    analysis and hit counter columns of every 10th rule filled in
+    """
+    row = (str(i + 1), action, 'IN', proto, src, '*', '*', dport, i)
+    if i % 10:
+        return row + (None, None, 0, 0, 0.0, '', '', '')
+    packets = i * 31
+    bytes = packets * 60
+    return row + ('#dddddd', 'Redundant: rule 1 matches all of its traffic '
+                  'with the same action', packets, bytes, 1.5, str(packets),
+                  get_formatted_size(bytes), '1.5/s')
+
+
+def make_rows(n):
+    rows = []
+    for i in xrange(n):
+        src = '10.0.%d.%d' % (i // 256, i % 256)
+        rows.append(make_row(i, 'ALLOW', 'TCP', src, str(1024 + i)))
+    return rows
+
+
+def renumber(rows):
+    return [(str(i + 1), ) + r[1:8] + (i, ) + r[RULE_COLUMNS:]
+            for i, r in enumerate(rows)]
+
+
+def edits(rows):
+    """Yield (name, new rows) for the usual single-rule operations"""
+    n = len(rows)
+    mid = n // 2
+    new = list(rows)
+    new.insert(mid, make_row(0, 'DENY', 'UDP', '*', '53'))
+    yield 'insert', renumber(new)
+    new = list(rows)
+    del new[mid]
+    yield 'delete', renumber(new)
+    new = list(rows)
+    new[mid] = new[mid][:1] + ('REJECT', ) + new[mid][2:]
+    yield 'edit', renumber(new)
+    new = list(rows)
+    new.insert(mid + 1, new.pop(mid))
+    yield 'move', renumber(new)
+
+
+def bench_rebuild(model, rows):
+    start = time.time()
+    model.clear()
+    for row in rows:
+        model.append(row)
+    return time.time() - start
+
+
+def bench_sync(model, old, rows):
+    start = time.time()
+    diff = diff_rows(old, rows, lambda r: r[1:8])
+    sync_list_model(model, old, rows, diff)
+    return time.time() - start
+
+
+def main():
+    # The UI file is found relative to the source tree
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.path.pardir))
+    columns = len(get_column_types())
+    assert len(make_row(0, 'ALLOW', 'TCP', '*', '22')) == columns
+    if gtk is not None:
+        print('model: rules_model (%d columns)' % (columns, ))
+        print('%8s %8s %12s %12s' % ('rules', 'edit', 'rebuild ms',
+                                     'sync ms'))
+    else:
+        print('model: list standing in for rules_model (%d columns), '
+              'no PyGTK; diff only' % (columns, ))
+        print('%8s %8s %12s' % ('rules', 'edit', 'diff ms'))
+    for n in (100, 1000, 10000):
+        rows = make_rows(n)
+        for name, new in edits(rows):
+            model = make_model()
+            bench_rebuild(model, rows)
+            t_rebuild = bench_rebuild(model, new)
+            model = make_model()
+            bench_rebuild(model, rows)
+            t_sync = bench_sync(model, rows, new)
+            assert [tuple(r) for r in model] == new
+            if gtk is not None:
+                print('%8d %8s %12.2f %12.2f' % (n, name, t_rebuild * 1000,
+                                                 t_sync * 1000))
+            else:
+                print('%8d %8s %12.2f' % (n, name, t_sync * 1000))
+
+
+if __name__ == '__main__':
+    main()
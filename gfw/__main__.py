@@ -0,0 +1,6 @@
+from gfw.l10n import ufw_localize
+from gfw.cli import main
+
+
+ufw_localize()
+main()
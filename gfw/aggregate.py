@@ -0,0 +1,148 @@
+#
+# aggregate.py: Aggregation of firewall events
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import time
+from collections import deque
+
+from gfw.util import pack_addr
+
+
+class SlidingCounter(object):
+    """Per-key counts over a sliding time window
+
+    The window is split into buckets, so counts expire one bucket at a time.
+    At most max_keys keys are tracked; when there are more, the ones with
+    the lowest counts are evicted. Keys whose counts changed since the last
+    call to pop_changed() are recorded so that views can update only them.
+    """
+
+    def __init__(self, window=60, buckets=12, max_keys=10000):
+        self.window = window
+        self.max_keys = max_keys
+        self._width = float(window) / buckets
+        # (start time, {key: count}) for each bucket, oldest first
+        self._buckets = deque()
+        self.totals = {}
+        self._changed = set()
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        start = now - self.window
+        while self._buckets and self._buckets[0][0] + self._width <= start:
+            for key, count in self._buckets.popleft()[1].iteritems():
+                total = self.totals[key] - count
+                if total > 0:
+                    self.totals[key] = total
+                else:
+                    del self.totals[key]
+                self._changed.add(key)
+
+    def add(self, key, now=None, count=1):
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        if not self._buckets or self._buckets[-1][0] + self._width <= now:
+            self._buckets.append((now, {}))
+        bucket = self._buckets[-1][1]
+        bucket[key] = bucket.get(key, 0) + count
+        self.totals[key] = self.totals.get(key, 0) + count
+        self._changed.add(key)
+        if len(self.totals) > self.max_keys:
+            self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the limit so this doesn't run on every add
+        n = len(self.totals) - self.max_keys * 9 // 10
+        cold = heapq.nsmallest(n, self.totals.iteritems(), key=lambda i: i[1])
+        for key, count in cold:
+            del self.totals[key]
+            for start, bucket in self._buckets:
+                bucket.pop(key, None)
+            self._changed.add(key)
+
+    def pop_changed(self):
+        """Returns the keys changed since the last call, with their counts
+
+        The count of a key which is no longer tracked is 0.
+        """
+        changed = self._changed
+        self._changed = set()
+        return [(key, self.totals.get(key, 0)) for key in changed]
+
+    def top(self, n):
+        return heapq.nlargest(n, self.totals.iteritems(), key=lambda i: i[1])
+
+
+class TopTalkers(object):
+    """Blocked event counts by source, by destination port and by both"""
+
+    GROUPS = ('src', 'port', 'pair')
+
+    def __init__(self, window=60, buckets=12, max_keys=10000):
+        self.counters = {}
+        for group in self.GROUPS:
+            self.counters[group] = SlidingCounter(window, buckets, max_keys)
+
+    def add_events(self, events, now=None):
+        if now is None:
+            now = time.time()
+        by_src = self.counters['src']
+        by_port = self.counters['port']
+        by_pair = self.counters['pair']
+        for e in events:
+            by_src.add(e.src, now)
+            by_port.add((e.dpt, e.proto), now)
+            by_pair.add((e.src, e.dpt), now)
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        for counter in self.counters.itervalues():
+            counter.expire(now)
+
+
+def group_connections(conns, local_addrs=frozenset()):
+    """Group connections by remote peer, destination port and protocol
+
+    conns is an iterable of (proto, src, sport, dst, dport) as returned by
+    gfw.util.get_connections(), and local_addrs the addresses of this host
+    as returned by gfw.util.get_local_addresses(). The peer is the source
+    of the original direction, unless that is a local address, i.e. the
+    connection was started by this host, in which case it is the
+    destination. Returns a dict mapping (proto, src, dst, dport), with the
+    local end left empty, to a dict whose keys and values are the
+    connections of the group. The connections are read in one pass.
+    """
+    groups = {}
+    # Source address -> whether it is local; most sources repeat
+    is_local = {}
+    for conn in conns:
+        local = is_local.get(conn[1])
+        if local is None:
+            local = is_local[conn[1]] = (pack_addr(conn[1]) in local_addrs)
+        if local:
+            key = (conn[0], '', conn[3], conn[4])
+        else:
+            key = (conn[0], conn[1], '', conn[4])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {}
+        group[conn] = conn
+    return groups
@@ -0,0 +1,264 @@
+#
+# analyze.py: Finding rules which never or only partly take effect
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+
+from gfw.util import parse_addr, parse_ports
+
+
+# Kinds of findings
+SHADOWED = 'shadowed'
+REDUNDANT = 'redundant'
+CONFLICTING = 'conflicting'
+
+# Rules with more destination ports than this are compared with all the
+# single port rules of each source network instead of looking up each of
+# their ports
+MAX_PORT_LOOKUPS = 64
+
+
+def _covers_ports(a, b):
+    """Whether the intervals a include all of the intervals b"""
+    firsts = [first for first, last in a]
+    for first, last in b:
+        # Merged intervals never touch, so b has to fit into one of them
+        i = bisect.bisect_right(firsts, first) - 1
+        if i < 0 or a[i][1] < last:
+            return False
+    return True
+
+
+def _overlaps_ports(a, b):
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i][1] < b[j][0]:
+            i += 1
+        elif b[j][1] < a[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+
+def _covers_addr(a, b):
+    """Whether the network a, as returned by parse_addr, contains b"""
+    bits, value, plen = a
+    return plen <= b[2] and b[1] >> (bits - plen) == value >> (bits - plen)
+
+
+class _Match(object):
+    """The traffic matched by a rule"""
+
+    def __init__(self, rule):
+        self.action = rule.action
+        self.direction = rule.direction
+        self.iface_in = rule.interface_in
+        self.iface_out = rule.interface_out
+        self.proto = rule.protocol
+        self.src = parse_addr(rule.src)
+        self.dst = parse_addr(rule.dst)
+        self.sports = parse_ports(rule.sport)
+        self.dports = parse_ports(rule.dport)
+
+    def covers(self, other):
+        """Whether this matches all of the traffic other matches"""
+        return (self.iface_in in ('', other.iface_in) and
+                self.iface_out in ('', other.iface_out) and
+                self.proto in ('any', other.proto) and
+                _covers_addr(self.src, other.src) and
+                _covers_addr(self.dst, other.dst) and
+                _covers_ports(self.sports, other.sports) and
+                _covers_ports(self.dports, other.dports))
+
+    def overlaps(self, other):
+        """Whether this matches any of the traffic other matches"""
+        # An empty interface or 'any' protocol matches all of them
+        for a, b in ((self.iface_in, other.iface_in),
+                     (self.iface_out, other.iface_out)):
+            if a and b and a != b:
+                return False
+        if (self.proto != other.proto and
+                'any' not in (self.proto, other.proto)):
+            return False
+        # Two networks overlap only if one contains the other
+        return ((_covers_addr(self.src, other.src) or
+                 _covers_addr(other.src, self.src)) and
+                (_covers_addr(self.dst, other.dst) or
+                 _covers_addr(other.dst, self.dst)) and
+                _overlaps_ports(self.sports, other.sports) and
+                _overlaps_ports(self.dports, other.dports))
+
+
+class _Node(object):
+    """The matches of the rules for one source network"""
+
+    def __init__(self):
+        # Destination port -> (rule index, match) of the rules for a single
+        # destination port
+        self.ports = {}
+        # Size class -> sorted lists of the first ports of the destination
+        # port intervals of the other rules, and of their (first, last,
+        # rule index, match). Intervals of size class c have 2**c to
+        # 2**(c + 1) - 1 ports, so those overlapping a port p are among the
+        # few whose first port lies in (p - 2**(c + 1), p].
+        self.firsts = {}
+        self.intervals = {}
+
+    def add(self, i, match):
+        dports = match.dports
+        if len(dports) == 1 and dports[0][0] == dports[0][1]:
+            self.ports.setdefault(dports[0][0], []).append((i, match))
+            return
+        for first, last in dports:
+            size = _get_size_class(first, last)
+            firsts = self.firsts.setdefault(size, [])
+            pos = bisect.bisect_right(firsts, first)
+            firsts.insert(pos, first)
+            self.intervals.setdefault(size, []).insert(pos,
+                    (first, last, i, match))
+
+    def get_overlapping(self, dports, found):
+        """Add the (rule index, match) of the rules with destination port
+        intervals overlapping dports to the dict found, by rule index
+        """
+        for size, firsts in self.firsts.iteritems():
+            intervals = self.intervals[size]
+            for first, last in dports:
+                lo = bisect.bisect_right(firsts, first - (2 << size))
+                hi = bisect.bisect_right(firsts, last)
+                for k in xrange(lo, hi):
+                    interval = intervals[k]
+                    if interval[1] >= first:
+                        found[interval[2]] = interval[2:]
+
+
+def _get_size_class(first, last):
+    """Returns the size class of a port interval, i.e. floor(log2(size))"""
+    return (last - first + 1).bit_length() - 1
+
+
+class _Index(object):
+    """The rules of one direction and address family by source network
+
+    This is a prefix trie flattened into a dict of (prefix length, prefix)
+    -> _Node, so that the networks containing an address are found with
+    one lookup per prefix length in use.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.lengths = []
+
+    def add(self, i, match):
+        bits, value, plen = match.src
+        key = (plen, value >> (bits - plen))
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = _Node()
+            if plen not in self.lengths:
+                bisect.insort(self.lengths, plen)
+        node.add(i, match)
+
+    def get_candidates(self, match):
+        """Returns the (rule index, match) of the rules whose source network
+        contains that of match and whose destination ports overlap
+        """
+        bits, value, plen = match.src
+        ports = None
+        count = sum(last - first + 1 for first, last in match.dports)
+        if count <= MAX_PORT_LOOKUPS:
+            ports = []
+            for first, last in match.dports:
+                ports.extend(xrange(first, last + 1))
+        found = {}
+        candidates = []
+        for length in self.lengths:
+            if length > plen:
+                break
+            node = self.nodes.get((length, value >> (bits - length)))
+            if node is None:
+                continue
+            if ports is None:
+                for matches in node.ports.itervalues():
+                    for m in matches:
+                        if _overlaps_ports(m[1].dports, match.dports):
+                            candidates.append(m)
+            else:
+                for port in ports:
+                    candidates.extend(node.ports.get(port, ()))
+            # A rule with several intervals may overlap more than once
+            node.get_overlapping(match.dports, found)
+        candidates.extend(found.itervalues())
+        return candidates
+
+
+def analyze(rules):
+    """Find the rules which never or only partly take effect
+
+    rules is a list of UFWRules in the order ufw evaluates them, e.g. the
+    rules of Frontend.get_rules(). A rule is:
+
+      * shadowed if an earlier rule with a different action matches all of
+        its traffic, so that it never takes effect
+      * redundant if an earlier rule with the same action does, so that it
+        can be deleted
+      * conflicting if an earlier rule with a different action, for the
+        same or a containing source network, matches part but not all of
+        its traffic, and does not just make an exception to it
+
+    Returns a dict of index in rules -> (kind, index of the earliest such
+    rule). Rules for app profiles whose ports are not known are skipped.
+
+    Each rule is only compared with the earlier rules of the networks
+    containing its source network, and of the destination ports it may
+    match, so typical rulesets take O(n log n) rather than O(n^2). Rules
+    which are shadowed or redundant are left out: an earlier rule matches
+    all of their traffic, so they are never the earliest covering rule, and
+    those which never take effect do not conflict with anything.
+    """
+    results = {}
+    indexes = {}
+    for i, rule in enumerate(rules):
+        try:
+            match = _Match(rule)
+        except ValueError:
+            continue
+        key = (match.direction, match.src[0])
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = _Index()
+        covering = conflicting = None
+        for j, other in index.get_candidates(match):
+            if covering is not None and j > covering:
+                continue
+            if other.covers(match):
+                covering = j
+            elif (other.action != match.action and
+                    (conflicting is None or j < conflicting) and
+                    other.overlaps(match) and not match.covers(other)):
+                conflicting = j
+        if covering is not None:
+            if rules[covering].action == rule.action:
+                results[i] = (REDUNDANT, covering)
+            else:
+                results[i] = (SHADOWED, covering)
+            continue
+        if conflicting is not None:
+            results[i] = (CONFLICTING, conflicting)
+        index.add(i, match)
+    return results
@@ -0,0 +1,149 @@
+#
+# cli.py: Command line frontend for ufw
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import difflib
+import sys
+from optparse import OptionParser
+
+from ufw.common import UFWError
+
+from gfw.frontend import Frontend
+
+
+USAGE = '''%prog [options] COMMAND [ARGS]
+
+Commands:
+  export [FILE]             write the rules as a ufw script
+  import [--atomic] [FILE]  add the rules of a ufw script
+  diff [FILE]               compare a ufw script with the rules
+  sync [--dry-run] [FILE]   change the rules to match a ufw script
+  move FROM TO              move a rule to another position
+  bulk-delete [POS...]      delete the rules at the given positions
+
+FILE defaults to the standard input or output, as does "-". bulk-delete
+reads the positions from the standard input if none are given. Positions
+are the rule numbers, counting from 1, in the order export writes them.'''
+
+
+def _open_input(path):
+    if path is None or path == '-':
+        # Read line by line instead of in blocks, so that rules piped in are
+        # applied as soon as they arrive
+        return iter(sys.stdin.readline, '')
+    return open(path, 'r')
+
+
+def _get_positions(args):
+    try:
+        return [int(a) for a in args]
+    except ValueError:
+        raise UFWError(_('Invalid rule position'))
+
+
+def do_export(frontend, options, args):
+    if not args or args[0] == '-':
+        frontend.write_rules(sys.stdout)
+    else:
+        frontend.export_rules(args[0])
+
+
+def do_import(frontend, options, args):
+    path = (args[0] if args else None)
+    stats = frontend.read_rules(_open_input(path), options.atomic)
+    if stats:
+        msg = 'parse %.2fs, write %.2fs, apply %.2fs\n'
+        sys.stderr.write(msg % (stats['parse'], stats['write'], stats['apply']))
+
+
+def do_diff(frontend, options, args):
+    path = (args[0] if args else None)
+    # Both sides are formatted the same way, so that only actual
+    # differences show up
+    lines = frontend.get_script_commands(_open_input(path))
+    current = frontend.get_rule_commands()
+    diff = list(difflib.unified_diff(current, lines, 'current', path or '-',
+                                     lineterm=''))
+    for line in diff:
+        sys.stdout.write(line + '\n')
+    # Like diff(1)
+    return (1 if diff else 0)
+
+
+def do_sync(frontend, options, args):
+    path = (args[0] if args else None)
+    plan = frontend.sync_rules(_open_input(path), options.dry_run)
+    for action, version, old, new, cmd in plan:
+        if action == 'delete':
+            pos = '%d' % (old, )
+        elif action == 'move':
+            pos = '%d -> %d' % (old, new)
+        else:
+            pos = '%d' % (new, )
+        sys.stdout.write('%s %s %s: %s\n' % (action, version, pos, cmd))
+
+
+def do_move(frontend, options, args):
+    if len(args) != 2:
+        raise UFWError(_('move takes two rule positions'))
+    old, new = _get_positions(args)
+    n = len(frontend.get_rules())
+    if not (1 <= old <= n and 1 <= new <= n):
+        raise UFWError(_('Invalid rule position'))
+    frontend.move_rule(old, new)
+
+
+def do_bulk_delete(frontend, options, args):
+    if not args:
+        args = sys.stdin.read().split()
+    frontend.delete_rules(_get_positions(args))
+
+
+COMMANDS = {
+    'export': do_export,
+    'import': do_import,
+    'diff': do_diff,
+    'sync': do_sync,
+    'move': do_move,
+    'bulk-delete': do_bulk_delete,
+}
+
+
+def main():
+    parser = OptionParser(usage=USAGE)
+    parser.disable_interspersed_args()
+    parser.add_option('--atomic', action='store_true', default=False,
+                      help=_('import: apply all rules or none, in a single '
+                             'write and reload'))
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help=_('sync: only print the changes'))
+    options, args = parser.parse_args()
+    if not args or args[0] not in COMMANDS:
+        parser.error(_('no valid command given'))
+    command = args.pop(0)
+    # Options may also follow the command
+    options, args = parser.parse_args(args, options)
+    try:
+        frontend = Frontend()
+        res = COMMANDS[command](frontend, options, args)
+    except UFWError as e:
+        sys.exit(e.value)
+    except IOError as e:
+        if e.filename:
+            sys.exit('%s: %s' % (e.filename, e.strerror))
+        sys.exit(e.strerror)
+    sys.exit(res)
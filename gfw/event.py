@@ -16,68 +16,299 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import mmap
+import os
 import re
+from collections import namedtuple
 
 import pyinotify
 
 
-_re_keyval = re.compile(r'([A-Z]+)=([^ ]*)')
-_re_event = re.compile(r'\[UFW ([A-Z ]+)\]')
+# Fields of a BLOCK event, in the order of the columns of the events view
+Event = namedtuple('Event', 'timestamp event iface_in iface_out proto '
+                            'src spt dst dpt')
+
+# The kernel always logs these keys in the same order
+_re_block = re.compile(r'(?P<timestamp>\S+\s+\S+\s+\S+)\s.*?'
+                       r'\[UFW (?P<event>(?:LIMIT )?BLOCK)\] '
+                       r'IN=(?P<iface_in>\S*) OUT=(?P<iface_out>\S*) '
+                       r'.*?SRC=(?P<src>\S*) DST=(?P<dst>\S*) '
+                       r'.*?PROTO=(?P<proto>\S*)'
+                       r'(?: SPT=(?P<spt>\d*) DPT=(?P<dpt>\d*))?')
+
+# Maximum number of events passed to the callback at once
+MAX_BATCH = 1000
+
+# Number of events read back from the log on startup
+BACKFILL = 100
+
+# Events on the log file itself and on its directory
+FILE_EVENTS = (pyinotify.IN_MODIFY | pyinotify.IN_MOVE_SELF |
+               pyinotify.IN_DELETE_SELF)
+DIR_EVENTS = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+
+
+def parse(line):
+    """Parse a log line into an Event
+
+    Only 'LIMIT BLOCK' and 'BLOCK' events are returned; None otherwise.
+    """
+    # Cheaply reject other lines before running the regex
+    if 'BLOCK] ' not in line:
+        return
+    m = _re_block.match(line)
+    if m is not None:
+        return Event(**m.groupdict(''))
+
+
+def _read_last(log, count):
+    """Read up to count of the last events in log, newest first
+
+    The log is scanned backwards from the end, so the cost only depends on
+    the number of lines read. Returns the events and the offset just past
+    the last complete line.
+    """
+    fd = log.fileno()
+    if not os.fstat(fd).st_size:
+        return ([], 0)
+    m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    try:
+        # An incomplete last line is read once it is completed
+        end = m.rfind('\n')
+        offset = end + 1
+        events = []
+        while end > 0 and len(events) < count:
+            start = m.rfind('\n', 0, end) + 1
+            data = parse(m[start:end])
+            if data is not None:
+                events.append(data)
+            end = start - 1
+    finally:
+        m.close()
+    return (events, offset)
 
 
 class EventHandler(pyinotify.ProcessEvent):
+    """Follows the log, across rotation, and passes the new events to the
+    callback
+
+    The log must be unbuffered (as opened by io.open with buffering=0), so
+    that what is read always reflects the file as it is now.
+    """
+
+    # Number of bytes last read which are compared to notice truncation
+    TAIL_SIZE = 64
 
-    def my_init(self, log, callback):
+    def my_init(self, wm, log, callback, max_batch=MAX_BATCH,
+                backfill=BACKFILL, rotated=True):
+        self._wm = wm
         self._log = log
+        self._path = log.name
+        self._wd = wm.add_watch(self._path, FILE_EVENTS)[self._path]
         self._callback = callback
-        # Seek to near EOF if log file is big enough
-        try:
-            self._log.seek(-4096, 2)
-        except IOError:
-            pass
-        # Get rid of a possibly incomplete line
-        self._log.readline()
-        for line in self._log:
+        self._max_batch = max_batch
+        # Trailing incomplete line from the last read
+        self._partial = ''
+        # The last bytes read, before the read position
+        self._tail = ''
+        # The rotated log, its watch and its incomplete line, read until the
+        # writer switches to the new log
+        self._old = None
+        self._backfill(backfill, rotated)
+
+    def _backfill(self, count, rotated):
+        """Pass the last count events to the callback
+
+        If rotated is True and the log doesn't have enough events, the rest
+        are read from the previous log (e.g. ufw.log.1).
+        """
+        events, offset = _read_last(self._log, count)
+        if rotated and len(events) < count:
+            try:
+                with io.open(self._path + '.1', 'rb') as f:
+                    events.extend(_read_last(f, count - len(events))[0])
+            except (IOError, OSError):
+                pass
+        self._seek(offset)
+        events.reverse()
+        for i in xrange(0, len(events), self._max_batch):
+            self._callback(events[i:i + self._max_batch], False)
+
+    def _parse(self, data):
+        return parse(data)
+
+    def _seek(self, offset):
+        start = max(0, offset - self.TAIL_SIZE)
+        self._log.seek(start)
+        self._tail = self._log.read(offset - start)
+
+    @staticmethod
+    def _read_lines(log, partial, flush=False):
+        """Read all the complete lines currently available in log
+
+        Returns them and the incomplete last line, which is included in the
+        lines instead if flush is True.
+        """
+        data = log.read()
+        lines = []
+        if data:
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+        if flush and partial:
+            lines.append(partial)
+            partial = ''
+        return (lines, partial, data)
+
+    def _dispatch(self, lines, notify=True):
+        events = []
+        for line in lines:
             data = self._parse(line)
             if data is not None:
-                self._callback(data, False)
+                events.append(data)
+        for i in xrange(0, len(events), self._max_batch):
+            self._callback(events[i:i + self._max_batch], notify)
 
-    def _parse(self, data):
+    def _process(self, notify=True):
+        lines = []
+        if self._old is not None:
+            log, wd, partial = self._old
+            lines, partial = self._read_lines(log, partial)[:2]
+            if not os.fstat(self._log.fileno()).st_size:
+                # The writer still appends to the old log
+                self._old = (log, wd, partial)
+                self._dispatch(lines, notify)
+                return
+            # The writer has switched to the new log, so all of the old one
+            # has been written and can be read to the end
+            lines.extend(self._read_lines(log, partial, True)[0])
+            self._close_old()
+        new, self._partial, data = self._read_lines(self._log, self._partial)
+        lines.extend(new)
+        if data:
+            self._tail = (self._tail + data)[-self.TAIL_SIZE:]
+        self._dispatch(lines, notify)
+
+    def _close_old(self):
+        log, wd, partial = self._old
+        self._old = None
+        self._wm.rm_watch(wd)
+        log.close()
+
+    def _is_rotated(self):
+        """Check whether the log path now refers to another file"""
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return False
+        return st.st_ino != os.fstat(self._log.fileno()).st_ino
+
+    def _is_truncated(self):
+        """Check whether the log was truncated since it was last read
+
+        Besides the file being shorter than the read position, the bytes
+        before it have to be those last read, in case the log already grew
+        again.
+        """
+        pos = self._log.tell()
+        if pos > os.fstat(self._log.fileno()).st_size:
+            return True
+        if not self._tail:
+            return False
+        self._log.seek(pos - len(self._tail))
+        truncated = (self._log.read(len(self._tail)) != self._tail)
+        self._log.seek(pos)
+        return truncated
+
+    def _read_copy(self):
+        """Returns what was not read of the log before it was truncated,
+        from the copy made by logrotate's copytruncate, if there is one
+
+        The copy is recognized by the bytes last read, so nothing can be
+        recovered if nothing was read since the log was opened or last
+        truncated.
+        """
+        pos = self._log.tell()
+        tail = self._tail
+        if not tail:
+            return ''
         try:
-            event = _re_event.findall(data)[0]
-        except IndexError:
-            return
-        # Only show 'LIMIT BLOCK' and 'BLOCK' events
-        if 'BLOCK' not in event:
-            return
-        timestamp = ' '.join(data.split()[:3])
-        conn = dict(_re_keyval.findall(data))
-        return (timestamp, event, conn)
+            with io.open(self._path + '.1', 'rb') as f:
+                f.seek(pos - len(tail))
+                if f.read(len(tail)) != tail:
+                    return ''
+                return f.read()
+        except (IOError, OSError):
+            return ''
+
+    def _reopen(self):
+        if self._old is not None:
+            # Rotated again before the writer switched to the last new log
+            lines = self._read_lines(self._old[0], self._old[2], True)[0]
+            self._dispatch(lines)
+            self._close_old()
+        # Read whatever was written to the old file before switching
+        self._process()
+        self._old = (self._log, self._wd, self._partial)
+        self._log = io.open(self._path, 'rb', 0)
+        self._wd = self._wm.add_watch(self._path, FILE_EVENTS)[self._path]
+        self._partial = ''
+        self._tail = ''
+        self._process()
+
+    def close(self):
+        if self._old is not None:
+            self._close_old()
+        self._log.close()
 
     def process_IN_MODIFY(self, event):
-        line = self._log.readline()
-        data = self._parse(line)
-        if data is not None:
-            self._callback(data)
+        if self._is_truncated():
+            # Truncated in place, e.g. by logrotate's copytruncate, so what
+            # was not read yet is only left in the copy
+            data = self._read_copy()
+            lines = (self._partial + data).split('\n')
+            self._partial = ''
+            self._dispatch([line for line in lines if line])
+            self._seek(0)
+        self._process()
+
+    def process_IN_MOVE_SELF(self, event):
+        # The writer may still append to the old file until it reopens the
+        # log, so keep reading it until the new file appears.
+        self._process()
+        if self._is_rotated():
+            self._reopen()
+
+    process_IN_DELETE_SELF = process_IN_MOVE_SELF
+
+    def process_IN_CREATE(self, event):
+        if event.pathname == self._path and self._is_rotated():
+            self._reopen()
+
+    process_IN_MOVED_TO = process_IN_CREATE
 
 
 class Notifier(pyinotify.Notifier):
 
-    def __init__(self, callback):
+    def __init__(self, callback, max_batch=MAX_BATCH, backfill=BACKFILL,
+                 rotated=True):
         try:
-            self._log = open('/var/log/ufw.log', 'r')
+            self._log = io.open('/var/log/ufw.log', 'rb', 0)
         except IOError:
             try:
-                self._log = open('/var/log/messages', 'r')
+                self._log = io.open('/var/log/messages', 'rb', 0)
             except IOError:
-                self._log = open('/var/log/messages.log', 'r')
-        handler = EventHandler(log=self._log, callback=callback)
+                self._log = io.open('/var/log/messages.log', 'rb', 0)
         wm = pyinotify.WatchManager()
-        wm.add_watch(self._log.name, pyinotify.IN_MODIFY)
-        pyinotify.Notifier.__init__(self, wm, handler)
+        # Watch the directory too, to notice when the log is rotated
+        wm.add_watch(os.path.dirname(self._log.name), DIR_EVENTS)
+        self._handler = EventHandler(wm=wm, log=self._log, callback=callback,
+                                     max_batch=max_batch, backfill=backfill,
+                                     rotated=rotated)
+        pyinotify.Notifier.__init__(self, wm, self._handler)
 
     def __del__(self):
-        self._log.close()
+        self._handler.close()
 
     def _trigger(self, *args):
         self.read_events()
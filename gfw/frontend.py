@@ -16,14 +16,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import os
 import shlex
+import time
+from contextlib import contextmanager
 
 import ufw.common
 import ufw.frontend
 from ufw.util import valid_address
 from ufw.parser import UFWCommandRule
 
-from gfw.util import ANY_ADDR
+import gfw.iptables
+from gfw.util import ANY_ADDR, diff_order
 
 # Override the error function used by UFWFrontend
 def _error(msg, exit=True):
@@ -34,6 +39,19 @@ ufw.frontend.error = _error
 
 class Frontend(ufw.frontend.UFWFrontend, object):
 
+    # Reports which also show live data, e.g. packet counters or listening
+    # sockets, and how long they are cached, in seconds
+    LIVE_REPORTS = ('raw', 'listening')
+    LIVE_REPORT_MAX_AGE = 10
+    # The iptables command and the rules files which ufw-init loads for
+    # each address family, in order
+    RULES_FILES = (
+        ('iptables', ('before_rules', 'rules', 'after_rules')),
+        ('ip6tables', ('before6_rules', 'rules6', 'after6_rules')),
+    )
+    # The backend's list of rules for each IP version
+    RULES_LISTS = (('v4', 'rules'), ('v6', 'rules6'))
+
     def __init__(self):
         super(Frontend, self).__init__(False)
         # Compatibility for ufw 0.31
@@ -47,6 +65,16 @@ class Frontend(ufw.frontend.UFWFrontend, object):
             self.backend._is_enabled
         except AttributeError:
             self.backend._is_enabled = self.backend.is_enabled
+        self._in_transaction = False
+        # Bumped whenever the backend's ruleset changes
+        self.generation = 0
+        # (generation, rules) of the cached result of get_rules, replaced as
+        # a whole so that other threads never see half of it
+        self._rules_cache = (-1, ())
+        # Report name -> (firewall state, time created, text)
+        self._reports = {}
+        # (defaults, input digest, live tables digest) of the last reload
+        self._reload_state = None
 
     @staticmethod
     def _get_ip_version(rule):
@@ -92,26 +120,439 @@ class Frontend(ufw.frontend.UFWFrontend, object):
         self.backend.set_default(self.backend.files['defaults'],
                                  'IPT_MODULES', modules)
 
-    def reload(self):
-        """Reload firewall"""
-        if self.backend._is_enabled():
+    def _set_defaults(self, path, values):
+        """Set options of a defaults file in one write
+
+        values maps option names to their values. Like backend.set_default,
+        the options in memory are updated once the file is written.
+        """
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        pending = dict(values)
+        for i, line in enumerate(lines):
+            opt = line.partition('=')[0]
+            if opt in pending:
+                lines[i] = '%s=%s\n' % (opt, pending.pop(opt))
+        for opt in sorted(pending):
+            lines.append('%s=%s\n' % (opt, pending[opt]))
+        tmp = path + '.new'
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+        os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        os.rename(tmp, path)
+        for opt, value in values.iteritems():
+            self.backend.defaults[opt.lower()] = value.lower().strip('"\'')
+
+    def set_preferences(self, loglevel, policies, ipv6, ipt_modules):
+        """Apply the preferences in one go
+
+        policies maps 'incoming' and 'outgoing' to 'allow', 'deny' or
+        'reject', and ipt_modules is a list of (module name, whether it
+        should be loaded). Only the settings which differ from the current
+        ones are changed, the defaults file is written at most once, and the
+        firewall is only reloaded if one of its settings changed. Returns
+        the names of the changed settings.
+        """
+        backend = self.backend
+        changed = []
+        # The log level is applied to the live rules by ufw itself
+        if backend.defaults.get('loglevel') != loglevel:
+            self.set_loglevel(loglevel)
+            changed.append('loglevel')
+        values = {}
+        chains = {'incoming': 'input', 'outgoing': 'output'}
+        targets = {'allow': 'ACCEPT', 'deny': 'DROP', 'reject': 'REJECT'}
+        for direction, policy in sorted(policies.iteritems()):
+            chain = chains[direction]
+            if backend.get_default_policy(chain) != policy:
+                opt = 'DEFAULT_%s_POLICY' % (chain.upper(), )
+                values[opt] = '"%s"' % (targets[policy], )
+                changed.append('%s_policy' % (direction, ))
+        if (backend.defaults.get('ipv6') == 'yes') != ipv6:
+            values['IPV6'] = ('yes' if ipv6 else 'no')
+            changed.append('ipv6')
+        modules = backend.defaults.get('ipt_modules', '').split()
+        new_modules = list(modules)
+        for module, enable in ipt_modules:
+            if enable and module not in new_modules:
+                new_modules.append(module)
+            elif not enable and module in new_modules:
+                new_modules.remove(module)
+        if new_modules != modules:
+            values['IPT_MODULES'] = '"%s"' % (' '.join(new_modules), )
+            changed.append('ipt_modules')
+        if values:
+            self._set_defaults(backend.files['defaults'], values)
+            self.reload(True)
+        return changed
+
+    def reload(self, full=False):
+        """Reload firewall
+
+        Unless full is True, the rules files are applied with one atomic
+        iptables-restore per address family, and nothing is done if neither
+        the files nor the live tables changed since the last reload. If that
+        is not possible, or the IPv6, module or default policy settings
+        changed, the firewall is disabled and enabled again.
+
+        Returns None if the firewall is disabled, otherwise a dict with the
+        method used ('skip', 'restore' or 'full') and the time it took.
+        """
+        if not self.backend._is_enabled():
+            return None
+        start = time.time()
+        method = None
+        if not full:
+            try:
+                method = self._reload_rules()
+            except (ufw.common.UFWError, EnvironmentError, ValueError):
+                method = None
+        if method is None:
+            self._reload_state = None
             self.set_enabled(False)
             self.set_enabled(True)
-            return True
+            method = 'full'
+            try:
+                plan = self._get_reload_plan()
+                if plan is not None:
+                    self._reload_state = self._get_reload_state(plan)
+            except (ufw.common.UFWError, EnvironmentError, ValueError):
+                pass
+        return {'method': method, 'time': time.time() - start}
+
+    def _get_reload_defaults(self):
+        # Reloading the rules files doesn't apply changes to these, nor to
+        # the default policies, e.g. default_input_policy
+        defaults = self.backend.defaults
+        policies = sorted((k, v) for k, v in defaults.iteritems()
+                          if k.startswith('default_'))
+        return (defaults.get('ipv6'), defaults.get('ipt_modules'),
+                tuple(policies))
+
+    def _get_reload_plan(self):
+        """Generate the input of iptables-restore for each address family
+
+        Returns a list of (command, input, live tables), or None if the rules
+        files cannot be applied this way: when they add rules to built-in
+        chains, which would then be duplicated, or declare chains which do
+        not exist yet.
+        """
+        backend = self.backend
+        families = self.RULES_FILES
+        if not backend.use_ipv6():
+            families = families[:1]
+        plan = []
+        for command, keys in families:
+            files = []
+            for key in keys:
+                with open(backend.files[key], 'r') as f:
+                    files.append(gfw.iptables.parse_tables(f))
+            command = getattr(backend, command, command)
+            live = gfw.iptables.save(command + '-save')
+            live = gfw.iptables.parse_tables(live.splitlines())
+            tables = gfw.iptables.merge_tables(*files)
+            if not self._add_user_jumps(tables, files[1], live):
+                return None
+            data = gfw.iptables.format_tables(tables)
+            plan.append((command, data, live))
+        return plan
+
+    @staticmethod
+    def _add_user_jumps(tables, user_tables, live):
+        """Check that tables can be restored over live, and add to them the
+        jumps to the user chains which ufw-init adds to the before chains.
+        """
+        user_chains = set()
+        for table in user_tables:
+            user_chains.update(table.get_chain_names())
+        live = dict((t.name, t) for t in live)
+        for table in tables:
+            if table.name not in live:
+                return False
+            live_chains = live[table.name].get_chain_names()
+            for chain, policy in table.chains:
+                if (chain in gfw.iptables.BUILTIN_CHAINS or
+                        chain not in live_chains):
+                    return False
+            for chain, rule in table.rules:
+                if chain in gfw.iptables.BUILTIN_CHAINS:
+                    return False
+            for chain in table.get_chain_names():
+                rules = table.get_chain_rules(chain)
+                for rule in live[table.name].get_chain_rules(chain):
+                    fields = rule.split()
+                    if (len(fields) == 4 and fields[2] == '-j' and
+                            fields[3] in user_chains and rule not in rules):
+                        table.rules.append((chain, rule))
+        return True
+
+    def _get_reload_state(self, plan):
+        data = ''.join(p[1] for p in plan)
+        live = ''.join(gfw.iptables.format_tables(p[2]) for p in plan)
+        return (self._get_reload_defaults(), hashlib.sha1(data).hexdigest(),
+                hashlib.sha1(live).hexdigest())
+
+    def _reload_rules(self):
+        """Apply the rules files without disabling the firewall
+
+        Returns the method used, or None if a full reload is needed.
+        """
+        state = self._reload_state
+        if (state is not None and
+                state[0] != self._get_reload_defaults()):
+            return None
+        plan = self._get_reload_plan()
+        if plan is None:
+            return None
+        if self._get_reload_state(plan) == state:
+            return 'skip'
+        for command, data, live in plan:
+            gfw.iptables.restore(command + '-restore', data)
+        # Digest the live tables as restored
+        plan = self._get_reload_plan()
+        if plan is not None:
+            self._reload_state = self._get_reload_state(plan)
         else:
-            return False
+            self._reload_state = None
+        return 'restore'
+
+    @contextmanager
+    def transaction(self):
+        """Batch rule changes into a single write and reload.
+
+        Within the block, rules are only changed in memory. The rules files
+        are written and the user chains reloaded once when the block exits.
+        If anything fails, the previous ruleset is restored. Yields a dict
+        which receives the time spent writing and applying the rules.
+        """
+        stats = {}
+        if self._in_transaction:
+            # Nested transaction; the outermost one commits
+            yield stats
+            return
+        backend = self.backend
+        saved = (backend.rules[:], backend.rules6[:])
+        committing = False
+        self._in_transaction = True
+        # Defer the backend's per-rule file writes and chain reloads. Without
+        # a reload, set_rule would change the live chains right away with
+        # one iptables call per rule, which a failure could not undo.
+        backend._write_rules = lambda v6=False: None
+        backend._reload_user_rules = lambda: None
+        backend._need_reload = lambda v6: True
+        try:
+            try:
+                yield stats
+            finally:
+                del backend._write_rules
+                del backend._reload_user_rules
+                del backend._need_reload
+                self._in_transaction = False
+            committing = True
+            self._commit(stats)
+            self._check_changed(saved)
+        except Exception:
+            backend.rules, backend.rules6 = saved
+            if committing:
+                self._rollback()
+            raise
+
+    def _rollback(self):
+        """Put back whatever a failed commit may have partially applied"""
+        # In a function of its own, so that an error here does not replace
+        # the one being raised again by the caller
+        try:
+            self._commit({})
+        except Exception:
+            pass
+
+    def _commit(self, stats):
+        backend = self.backend
+        start = time.time()
+        backend._write_rules(False)
+        backend._write_rules(True)
+        stats['write'] = time.time() - start
+        start = time.time()
+        if backend._is_enabled():
+            backend._reload_user_rules()
+        stats['apply'] = time.time() - start
+
+    def _check_changed(self, saved):
+        """Bump the generation if the ruleset differs from saved"""
+        backend = self.backend
+        # UFWRule has no __eq__, so this compares the rule objects themselves
+        if (backend.rules, backend.rules6) != saved:
+            self.generation += 1
+
+    def _track_changes(self, func, *args):
+        if self._in_transaction:
+            # The transaction checks for changes once it is committed
+            return func(*args)
+        backend = self.backend
+        saved = (backend.rules[:], backend.rules6[:])
+        try:
+            return func(*args)
+        finally:
+            self._check_changed(saved)
 
     def get_rules(self):
-        """Returns a generator of processed rules"""
-        app_rules = []
+        """Returns a tuple of processed rules as (index, rule) pairs
+
+        The result is cached until the ruleset generation changes. It may be
+        called from the worker and the main thread at the same time.
+        """
+        # Read the generation before the rules, so that a change made
+        # meanwhile by another thread invalidates the result
+        generation = self.generation
+        cached_generation, cached = self._rules_cache
+        if cached_generation == generation and not self._in_transaction:
+            return cached
+        app_rules = set()
+        rules = []
         for i, r in enumerate(self.backend.get_rules()):
             if r.dapp or r.sapp:
                 t = r.get_app_tuple()
                 if t in app_rules:
                     continue
                 else:
-                    app_rules.append(t)
-            yield (i, r)
+                    app_rules.add(t)
+            rules.append((i, r))
+        rules = tuple(rules)
+        if not self._in_transaction:
+            self._rules_cache = (generation, rules)
+        return rules
+
+    def _get_firewall_state(self):
+        """Returns a value which changes whenever the firewall may have changed
+
+        Besides the ruleset generation, this covers changes made outside of
+        this frontend, e.g. with the ufw command, since ufw writes its rules
+        and configuration files whenever it changes the iptables state.
+        """
+        state = [self.generation]
+        for name, path in sorted(self.backend.files.iteritems()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                state.append(None)
+            else:
+                state.append((st.st_ino, st.st_size, st.st_mtime))
+        return tuple(state)
+
+    def get_cached_report(self, report):
+        """Returns the cached report, or None if it is out of date"""
+        try:
+            state, created, text = self._reports[report]
+        except KeyError:
+            return None
+        if state != self._get_firewall_state():
+            return None
+        if (report in self.LIVE_REPORTS and
+                time.time() - created > self.LIVE_REPORT_MAX_AGE):
+            return None
+        return text
+
+    def get_report(self, report):
+        """Returns the output of 'ufw show <report>'
+
+        The result is cached until the firewall changes.
+        """
+        text = self.get_cached_report(report)
+        if text is None:
+            # Get the state first so that concurrent changes invalidate it
+            state = self._get_firewall_state()
+            created = time.time()
+            if report == 'listening':
+                text = self.get_show_listening()
+            else:
+                text = self.get_show_raw(report)
+            self._reports[report] = (state, created, text)
+        return text
+
+    @staticmethod
+    def _get_user_rule_lines(lines):
+        """Returns a dict of chain -> list of (rule number, target) of the
+        iptables rules in a ufw user rules file, in order.
+
+        The rule number counts the '### tuple ###' comments which precede
+        the iptables rules of each ufw rule, so it is the index of the rule
+        in the backend's list. It is None for other rules, e.g. of the
+        logging chains.
+        """
+        chains = {}
+        n = -1
+        current = None
+        for line in lines:
+            if line.startswith('### tuple ###'):
+                n += 1
+                current = n
+            elif line.startswith('### END RULES'):
+                current = None
+            elif line.startswith('-A '):
+                fields = line.split()
+                target = None
+                if '-j' in fields[:-1]:
+                    target = fields[len(fields) - fields[::-1].index('-j')]
+                chains.setdefault(fields[1], []).append((current, target))
+        return chains
+
+    def get_rule_counters(self):
+        """Returns the packets and bytes matched by each rule of get_rules()
+
+        The result is a list of (packets, bytes), or None for rules whose
+        counters are not known, e.g. when the live rules do not match the
+        rules files. The counters of all the iptables rules of a ufw rule,
+        and of the rules hidden by get_rules(), are added up. Takes a single
+        iptables-save call per address family.
+        """
+        backend = self.backend
+        totals = {}
+        offset = 0
+        for (command, keys), (version, name) in zip(self.RULES_FILES,
+                                                     self.RULES_LISTS):
+            if version == 'v4' or backend.use_ipv6():
+                with open(backend.files[keys[1]], 'r') as f:
+                    expected = self._get_user_rule_lines(f)
+                command = getattr(backend, command, command)
+                live = gfw.iptables.save(command + '-save', counters=True)
+                live = gfw.iptables.parse_counters(live.splitlines())
+                self._add_counters(totals, offset, expected, live)
+            offset += len(getattr(backend, name))
+        rules = self.get_rules()
+        positions = {}
+        for pos, (i, r) in enumerate(rules):
+            positions[i] = pos
+            if r.dapp or r.sapp:
+                positions[r.get_app_tuple()] = pos
+        counters = [None] * len(rules)
+        all_rules = backend.get_rules()
+        for i, (packets, bytes) in totals.iteritems():
+            pos = positions.get(i)
+            if pos is None:
+                # A rule hidden by get_rules()
+                pos = positions.get(all_rules[i].get_app_tuple())
+            if pos is not None:
+                old = counters[pos] or (0, 0)
+                counters[pos] = (old[0] + packets, old[1] + bytes)
+        return counters
+
+    @staticmethod
+    def _add_counters(totals, offset, expected, live):
+        for chain, lines in expected.iteritems():
+            counted = live.get(chain, [])
+            # The live rules are those of the rules file, unless the file has
+            # been changed and not applied yet
+            if [t for n, t in lines] != [c[2] for c in counted]:
+                continue
+            for (n, target), (packets, bytes, t) in zip(lines, counted):
+                if n is None:
+                    continue
+                total = totals.setdefault(offset + n, [0, 0])
+                # Logging rules and the recent --set of limit rules see the
+                # same packets as the rule which accepts or denies them
+                if target not in (None, 'LOG', 'RETURN'):
+                    total[0] += packets
+                    total[1] += bytes
 
     ## Modified version of UFWCommandRule.get_command()
     ## It correctly exports the command string for DENY OUT rules
@@ -180,29 +621,176 @@ class Frontend(ufw.frontend.UFWFrontend, object):
 
         return res
 
+    @classmethod
+    def _format_command(cls, rule):
+        rule = rule.dup_rule()
+        # Enclose app names in quotation marks
+        if rule.sapp:
+            rule.sapp = "'" + rule.sapp + "'"
+        if rule.dapp:
+            rule.dapp = "'" + rule.dapp + "'"
+        return 'ufw ' + cls._get_command(rule)
+
+    def get_rule_commands(self):
+        """Returns the ufw commands which add the rules, in order"""
+        return [self._format_command(r) for i, r in self.get_rules()]
+
+    def get_script_commands(self, lines):
+        """Returns the rules of a rule script as get_rule_commands() would"""
+        return [self._format_command(r) for n, r, v in self._parse_rules(lines)]
+
     def export_rules(self, path):
         with open(path, 'w') as f:
-            f.write('#!/bin/sh\n')
-            for i, rule in self.get_rules():
-                rule = rule.dup_rule()
-                # Enclose app names in quotation marks
-                if rule.sapp:
-                    rule.sapp = "'" + rule.sapp + "'"
-                if rule.dapp:
-                    rule.dapp = "'" + rule.dapp + "'"
-                cmd = 'ufw ' + self._get_command(rule) + '\n'
-                f.write(cmd)
-
-    def import_rules(self, path):
-        with open(path, 'r') as f:
-            for line in f:
-                if not line.startswith('ufw '):
-                    continue
-                args = shlex.split(line)
-                args[0] = 'rule'
+            self.write_rules(f)
+
+    def write_rules(self, f):
+        """Write the rules to the file object f as a shell script"""
+        f.write('#!/bin/sh\n')
+        for cmd in self.get_rule_commands():
+            f.write(cmd + '\n')
+
+    @staticmethod
+    def _parse_rules(lines):
+        """Returns a generator of (line number, rule, IP version)"""
+        for n, line in enumerate(lines):
+            if not line.startswith('ufw '):
+                continue
+            args = shlex.split(line)
+            args[0] = 'rule'
+            try:
                 p = UFWCommandRule(args[1])
                 pr = p.parse(args)
-                self.set_rule(pr.data['rule'], pr.data['iptype'])
+            except ufw.common.UFWError as e:
+                err_msg = _('Line %d: %s') % (n + 1, e.value)
+                raise ufw.common.UFWError(err_msg)
+            yield (n + 1, pr.data['rule'], pr.data['iptype'])
+
+    def import_rules(self, path, atomic=False):
+        """import_rules(path, atomic=False)
+
+        In atomic mode, the whole file is parsed and validated first and the
+        rules are applied in a single transaction. Nothing is changed if any
+        line fails. Returns the time spent in the parse, write and apply
+        stages.
+        """
+        with open(path, 'r') as f:
+            return self.read_rules(f, atomic)
+
+    def read_rules(self, lines, atomic=False):
+        """Like import_rules, but reads the lines of a rule script from an
+        iterable, e.g. a pipe. Unless atomic is True, each rule is applied
+        as soon as its line is read.
+        """
+        if not atomic:
+            for n, rule, ip_version in self._parse_rules(lines):
+                self.set_rule(rule, ip_version)
+            return
+        start = time.time()
+        rules = list(self._parse_rules(lines))
+        with self.transaction() as stats:
+            for n, rule, ip_version in rules:
+                try:
+                    self.set_rule(rule, ip_version)
+                except ufw.common.UFWError as e:
+                    err_msg = _('Line %d: %s') % (n, e.value)
+                    raise ufw.common.UFWError(err_msg)
+            stats['parse'] = time.time() - start
+        return stats
+
+    def _group_by_command(self, rules):
+        """Returns the commands of rules in order, and a dict of command ->
+        rules. The rules added for an application share one command.
+        """
+        commands = []
+        groups = {}
+        for r in rules:
+            cmd = self._format_command(r)
+            if cmd not in groups:
+                groups[cmd] = []
+                commands.append(cmd)
+            groups[cmd].append(r)
+        return commands, groups
+
+    def _get_sync_target(self, lines):
+        """Returns a dict of IP version -> (commands, command -> rule) with
+        the rules of a rule script, without duplicates
+        """
+        versions = ['v4']
+        if self.backend.use_ipv6():
+            versions.append('v6')
+        target = dict((v, ([], {})) for v in versions)
+        for n, rule, ip_version in self._parse_rules(lines):
+            if ip_version == 'both':
+                rule_versions = versions
+            elif ip_version in target:
+                rule_versions = (ip_version, )
+            else:
+                err_msg = _('Line %d: IPv6 support is disabled') % (n, )
+                raise ufw.common.UFWError(err_msg)
+            cmd = self._format_command(rule)
+            for v in rule_versions:
+                commands, rules = target[v]
+                if cmd not in rules:
+                    commands.append(cmd)
+                    rules[cmd] = rule
+        return target
+
+    def _get_sync_plan(self, target):
+        plan = []
+        for version, name in self.RULES_LISTS:
+            if version not in target:
+                continue
+            old = self._group_by_command(getattr(self.backend, name))[0]
+            new = target[version][0]
+            removed, added, moved = diff_order(old, new)
+            for i, cmd in enumerate(old):
+                if cmd in removed:
+                    plan.append(('delete', version, i + 1, None, cmd))
+            old_positions = dict((cmd, i) for i, cmd in enumerate(old))
+            for i, cmd in enumerate(new):
+                if cmd in moved:
+                    plan.append(('move', version, old_positions[cmd] + 1,
+                                 i + 1, cmd))
+                elif cmd in added:
+                    plan.append(('insert', version, None, i + 1, cmd))
+        return plan
+
+    def sync_rules(self, lines, dry_run=False):
+        """sync_rules(lines, dry_run=False)
+
+        Makes the rules match a rule script with as few changes as possible.
+        Rules are matched on the command export_rules writes for them,
+        separately for IPv4 and IPv6. Only the missing rules are added,
+        only those not in the script are deleted, and only the fewest rules
+        needed to put the rest in order are moved, all in a single write and
+        reload. Unlike reset followed by import_rules, the rules which are
+        kept stay in effect throughout.
+
+        Returns the plan as a list of (action, IP version, old position, new
+        position, command), where action is 'delete', 'move' or 'insert' and
+        positions count from 1 among the rules of the IP version. Nothing is
+        changed if dry_run is True.
+        """
+        target = self._get_sync_target(lines)
+        plan = self._get_sync_plan(target)
+        if dry_run or not plan:
+            return plan
+        backend = self.backend
+        with self.transaction():
+            for action, version, old, new, cmd in plan:
+                if action == 'insert':
+                    self.set_rule(target[version][1][cmd], version)
+            # Put the rules in order and drop the others, as reorder_rules
+            # does
+            for version, name in self.RULES_LISTS:
+                if version not in target:
+                    continue
+                groups = self._group_by_command(getattr(backend, name))[1]
+                rules = []
+                for cmd in target[version][0]:
+                    rules.extend(groups.get(cmd, ()))
+                setattr(backend, name, rules)
+        return plan
 
     def set_rule(self, rule, ip_version=None):
         """set_rule(rule, ip_version=None)
@@ -224,7 +812,8 @@ class Frontend(ufw.frontend.UFWFrontend, object):
         # If trying to insert beyond the end, just set position to 0
         if rule.position and not self.backend.get_rule_by_number(rule.position):
             rule.set_position(0)
-        res = super(Frontend, self).set_rule(rule, ip_version)
+        res = self._track_changes(super(Frontend, self).set_rule, rule,
+                                  ip_version)
         # Reset the positions of the recently inserted rule(s)
         if rule.position:
             s = rule.position - 1
@@ -233,6 +822,42 @@ class Frontend(ufw.frontend.UFWFrontend, object):
                 r.set_position(0)
         return res
 
+    def reset(self, force=False):
+        """reset(force=False)
+
+        Changes:
+            * the rules are read back from the restored rules files
+        """
+        def reset():
+            res = super(Frontend, self).reset(force)
+            self.backend.rules = []
+            self.backend.rules6 = []
+            self.backend._read_rules()
+            return res
+        return self._track_changes(reset)
+
+    def application_update(self, profile):
+        return self._track_changes(
+                super(Frontend, self).application_update, profile)
+
+    def delete_rules(self, positions):
+        """delete_rules(positions)
+
+        Deletes the rules at the given positions of get_rules(), counting
+        from 1, with a single write and reload.
+        """
+        rules = self.get_rules()
+        indexes = set()
+        for pos in positions:
+            if not 1 <= pos <= len(rules):
+                err_msg = _('Invalid rule position: %d') % (pos, )
+                raise ufw.common.UFWError(err_msg)
+            indexes.add(rules[pos - 1][0])
+        with self.transaction():
+            # Delete from the end so that the other positions stay valid
+            for i in sorted(indexes, reverse=True):
+                self.delete_rule(i + 1, True)
+
     def update_rule(self, pos, rule):
         self.delete_rule(pos, True)
         if not rule.position:
@@ -242,7 +867,46 @@ class Frontend(ufw.frontend.UFWFrontend, object):
     def move_rule(self, old, new):
         if old == new:
             return
-        rule = self.backend.get_rule_by_number(old).dup_rule()
-        self.delete_rule(old, True)
-        rule.set_position(new)
-        self.set_rule(rule)
+        order = range(len(self.get_rules()))
+        order.insert(new - 1, order.pop(old - 1))
+        self.reorder_rules(order)
+
+    def reorder_rules(self, order):
+        """reorder_rules(order)
+
+        Moves the rule at index order[i] of get_rules() to index i, with a
+        single write and reload. IPv6 rules are always kept after the IPv4
+        rules, so the order is applied to each of them separately.
+        """
+        n = len(self.get_rules())
+        if sorted(order) != range(n):
+            raise ufw.common.UFWError(_('Invalid rule order'))
+        backend = self.backend
+        # Group the app rules hidden by get_rules() with the rule shown for
+        # them, along with the IP version of each backend rule
+        groups = []
+        app_rules = {}
+        entries = [(False, r) for r in backend.rules]
+        entries.extend((True, r) for r in backend.rules6)
+        for v6, r in entries:
+            if r.dapp or r.sapp:
+                t = r.get_app_tuple()
+                if t in app_rules:
+                    groups[app_rules[t]].append((v6, r))
+                    continue
+                else:
+                    app_rules[t] = len(groups)
+            groups.append([(v6, r)])
+        rules = []
+        rules6 = []
+        for i in order:
+            for v6, r in groups[i]:
+                if v6:
+                    rules6.append(r)
+                else:
+                    rules.append(r)
+        if rules == backend.rules and rules6 == backend.rules6:
+            return
+        with self.transaction():
+            backend.rules = rules
+            backend.rules6 = rules6
@@ -17,6 +17,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import time
+from collections import deque
+from optparse import OptionParser
+from itertools import islice
+
+# Start of the startup timing
+_import_start = time.time()
 
 import gobject
 import gtk
@@ -27,26 +34,33 @@ import gtk
 from ufw.common import UFWRule, UFWError
 
 import gfw.util
-import gfw.event
+import gfw.aggregate
+import gfw.analyze
+import gfw.search
+import gfw.worker
 from gfw.frontend import Frontend
 
+_import_end = time.time()
+
 
-class Notifier(gfw.event.Notifier):
+class Notifier(object):
+    """Watches the log for events from the GTK main loop"""
 
-    def __init__(self, callback, inactive_handler):
-        self._active = False
+    def __init__(self, callback, inactive_handler, backfill):
+        # Imported here so that pyinotify is only loaded once it is needed
+        import gfw.event
+        self._notifier = None
         try:
-            gfw.event.Notifier.__init__(self, callback)
+            self._notifier = gfw.event.Notifier(callback, backfill=backfill)
         except IOError:
             inactive_handler()
             return
-        self._active = True
-        self._w = gobject.io_add_watch(self._fd, gobject.IO_IN | gobject.IO_PRI,
-                                       self._trigger)
+        self._w = gobject.io_add_watch(self._notifier._fd,
+                                       gobject.IO_IN | gobject.IO_PRI,
+                                       self._notifier._trigger)
 
     def __del__(self):
-        if self._active:
-            gfw.event.Notifier.__del__(self)
+        if self._notifier is not None:
             gobject.source_remove(self._w)
 
 
@@ -66,43 +80,221 @@ class GtkFrontend(Frontend):
 
     UI_FILE = 'ufw-gtk.ui'
     RESPONSE_OK = -5
-    MAX_EVENTS = 100
-
-    def __init__(self):
+    # Responses of the diagnostics dialog
+    RESPONSE_REFRESH = 1
+    RESPONSE_SAVE = 2
+    # Default number of events kept in the events view
+    MAX_EVENTS = 1000
+    # Default number of events read back from the log on startup
+    BACKFILL_EVENTS = 100
+    # Maximum number of times per second the events view is updated
+    EVENTS_REFRESH_RATE = 4
+    # Time window of the top talkers view, in seconds
+    TALKERS_WINDOW = 60
+    # Intervals for writing to and compacting the event store, in seconds
+    STORE_FLUSH_INTERVAL = 5
+    STORE_COMPACT_INTERVAL = 3600
+    # Time spans of the entries of events_range_cbox, in seconds
+    EVENTS_RANGES = (None, 3600, 86400, 7 * 86400, 0)
+    # Detach a model from its view when more rows than this change
+    BULK_UPDATE_ROWS = 500
+    # Seconds between refreshes of the rule hit counters, while the rules
+    # are shown; 0 disables them
+    COUNTERS_INTERVAL = 0
+    RULES_PAGE = 0
+    RULES_DND_TARGET = 'application/x-ufw-rules'
+    # Background colors and tooltips of the rules found by gfw.analyze
+    ANALYSIS_COLORS = {
+        gfw.analyze.SHADOWED: '#f4c7c3',
+        gfw.analyze.REDUNDANT: '#dddddd',
+        gfw.analyze.CONFLICTING: '#fce8b2',
+    }
+    ANALYSIS_TOOLTIPS = {
+        gfw.analyze.SHADOWED: 'Never matches: rule %d matches all of its '
+                              'traffic with a different action',
+        gfw.analyze.REDUNDANT: 'Redundant: rule %d matches all of its '
+                               'traffic with the same action',
+        gfw.analyze.CONFLICTING: 'Partly overridden: rule %d matches some '
+                                 'of its traffic with a different action',
+    }
+
+    def __init__(self, event_store=None, startup_timing=False,
+                 instrument=False, counters_interval=None,
+                 backfill_events=None, max_events=None):
+        self._phases = [('import', _import_end - _import_start)]
+        self._phase_start = time.time()
+        self._startup_timing = startup_timing
         super(GtkFrontend, self).__init__()
+        self._instrument = None
+        if instrument:
+            import gfw.instrument
+            self._instrument = gfw.instrument.Instrument()
+            self._instrument.attach(self)
+        self._mark_phase('backend')
         self.ui = Builder()
         path = gfw.util.get_ui_path(self.UI_FILE)
         self.ui.add_from_file(path)
+        self._mark_phase('ui')
+        if self._instrument is not None:
+            import pango
+            self.ui.diagnostics_dialog_show.set_visible(True)
+            font = pango.FontDescription('monospace')
+            self.ui.diagnostics_view.modify_font(font)
         self._selection = self.ui.rules_view.get_selection()
+        self._selection.set_mode(gtk.SELECTION_MULTIPLE)
+        self._pending_select = None
+        targets = [(self.RULES_DND_TARGET, gtk.TARGET_SAME_WIDGET, 0)]
+        self.ui.rules_view.enable_model_drag_source(gtk.gdk.BUTTON1_MASK,
+                targets, gtk.gdk.ACTION_MOVE)
+        self.ui.rules_view.enable_model_drag_dest(targets, gtk.gdk.ACTION_MOVE)
         # models
+        self._rules_rows = []
+        # Built when the rules are first filtered after they change
+        self._rules_index = None
+        # Positions of the rules shown while filtering, otherwise None
+        self._rules_visible = None
+        self.ui.rules_filter.set_visible_func(self._is_rule_visible)
+        # Rule index -> (packets, bytes, packet rate) of the ruleset
+        # generation they were counted for, and when
+        self._counters = {}
+        self._counters_generation = None
+        self._counters_time = None
+        self._counters_pending = False
+        # Rule position -> (kind, position of the other rule) found by
+        # gfw.analyze for a ruleset generation, and the generation of the
+        # analysis still running
+        self._analysis = {}
+        self._analysis_generation = None
+        self._analysis_pending = None
+        # Backend operations are run in order on a background thread
+        self._worker = gfw.worker.Worker(gobject.idle_add, self._set_busy)
+        self._busy_timer = None
         self._update_rules_model()
-        self._update_apps_model()
+        self._mark_phase('rules')
+        # Filled when idle, or when the rule dialog is first shown
+        self._apps_loaded = False
         # actions and action groups
         self._init_action_groups()
-        self._init_prefs_dialog()
         # connect signals
         self.ui.connect_signals(self)
         self._update_action_states()
+        if counters_interval is None:
+            counters_interval = self.COUNTERS_INTERVAL
+        self._counters_interval = counters_interval
+        if counters_interval > 0:
+            gobject.timeout_add_seconds(counters_interval,
+                                        self._refresh_counters)
+        else:
+            for name in ('treeviewcolumn27', 'treeviewcolumn28',
+                         'treeviewcolumn29'):
+                self.ui.get_object(name).set_visible(False)
         self._conn_timer = None
-        def callback(data, notify=True):
-            timestamp, event, conn = data
-            #if notify:
-                #n = pynotify.Notification(_('Firewall'), _('Blocked incoming connection from %s') % (conn['SRC'], ), gtk.STOCK_INFO)
-                #n.show()
-            if len(self.ui.events_model) > self.MAX_EVENTS:
-                i = self.ui.events_model.get_iter_first()
-                self.ui.events_model.remove(i)
-            spt = conn.get('SPT', '')
-            dpt = conn.get('DPT', '')
-            data = (timestamp, event, conn['IN'], conn['OUT'], conn['PROTO'],
-                    conn['SRC'], spt, conn['DST'], dpt)
-            self.ui.events_model.append(data)
-        self._notifier = Notifier(callback,
-                lambda: self.ui.events_view.set_sensitive(False))
+        # Row of each group in the connections view, and of each connection
+        # in a group
+        self._conns_rows = {}
+        self._conns_children = {}
+        self._conns_pending = False
+        if max_events is None:
+            max_events = self.MAX_EVENTS
+        self._max_events = max_events
+        self._events = deque(maxlen=max_events)
+        if backfill_events is None:
+            backfill_events = self.BACKFILL_EVENTS
+        self._backfill_events = backfill_events
+        # Number of events not yet shown, and the pending refresh
+        self._events_pending = 0
+        self._events_timer = None
+        # Whether the events view shows live events or query results
+        self._events_live = True
+        # Shown once the event store is opened
+        self._store = None
+        self.ui.events_query_box.set_no_show_all(True)
+        self.ui.events_query_box.hide()
+        self._talkers = gfw.aggregate.TopTalkers(self.TALKERS_WINDOW)
+        self._talkers_group = gfw.aggregate.TopTalkers.GROUPS[0]
+        # Row of each key shown in the top talkers view
+        self._talkers_rows = {}
+        self.ui.talkers_model.set_sort_column_id(2, gtk.SORT_DESCENDING)
+        self.ui.conns_model.set_sort_column_id(5, gtk.SORT_DESCENDING)
+        msg = _('Blocked packets in the last %d seconds') % (self.TALKERS_WINDOW, )
+        self.ui.talkers_label.set_text(msg)
+        gobject.timeout_add_seconds(1, self._update_talkers_model)
+        self._notifier = None
         self.ui.main_window.show_all()
         ## FIXME: for the 0.3.0 release, hide the tab for the connections view
         page = self.ui.view.get_nth_page(2)
         page.hide()
+        self._mark_phase('window')
+        # The rest is set up from idle callbacks, which only run once the
+        # window has been drawn
+        self._deferred = [
+            ('draw', lambda: None),
+            ('apps', self._init_apps_model),
+            ('events', lambda: self._init_events(event_store)),
+        ]
+        if counters_interval > 0:
+            self._deferred.append(('counters', self._refresh_counters))
+        gobject.idle_add(self._run_deferred)
+
+    def _mark_phase(self, phase):
+        now = time.time()
+        self._phases.append((phase, now - self._phase_start))
+        self._phase_start = now
+
+    def _run_deferred(self):
+        """Run one deferred startup phase per call"""
+        phase, func = self._deferred.pop(0)
+        func()
+        self._mark_phase(phase)
+        if self._deferred:
+            return True
+        if self._startup_timing:
+            self._print_startup_timing()
+        return False
+
+    def _print_startup_timing(self):
+        total = 0
+        for phase, t in self._phases:
+            sys.stderr.write('%-10s %8.1f ms\n' % (phase, t * 1000))
+            total += t
+        sys.stderr.write('%-10s %8.1f ms\n' % ('total', total * 1000))
+
+    def _init_apps_model(self):
+        if not self._apps_loaded:
+            self._update_apps_model()
+
+    def _init_events(self, event_store):
+        self._init_event_store(event_store)
+        self._notifier = Notifier(self._add_events,
+                lambda: self.ui.events_view.set_sensitive(False),
+                self._backfill_events)
+
+    def _init_event_store(self, path):
+        if path is None:
+            return
+        # Imported here as the event store is optional
+        import sqlite3
+        import gfw.store
+        try:
+            self._store = gfw.store.EventStore(path)
+        except (sqlite3.Error, IOError) as e:
+            msg = _('Cannot open event store: %s') % (e, )
+            sys.stderr.write(msg + '\n')
+            return
+        self.ui.events_query_box.set_no_show_all(False)
+        self.ui.events_query_box.show_all()
+        gobject.timeout_add_seconds(self.STORE_FLUSH_INTERVAL,
+                                    self._flush_event_store)
+        gobject.timeout_add_seconds(self.STORE_COMPACT_INTERVAL,
+                                    self._compact_event_store)
+
+    def _flush_event_store(self):
+        self._store.flush()
+        return True
+
+    def _compact_event_store(self):
+        self._store.compact()
+        return True
 
     def _init_prefs_dialog(self):
         conf = self.backend.defaults
@@ -170,9 +362,61 @@ class GtkFrontend(Frontend):
         action.set_short_label(short_label)
         action.set_stock_id(stock_id)
         # Enable/disable related controls
-        self.ui.rules_view.set_sensitive(active)
-        self.ui.rule_actions.set_sensitive(active)
-        self.ui.firewall_actions.set_sensitive(active)
+        busy = self._worker.busy
+        action.set_sensitive(not busy)
+        self.ui.rules_view.set_sensitive(active and not busy)
+        self.ui.rules_filter_entry.set_sensitive(not busy)
+        self.ui.rule_actions.set_sensitive(active and not busy)
+        self.ui.firewall_actions.set_sensitive(active and not busy)
+
+    def _set_busy(self, busy):
+        if busy:
+            cursor = gtk.gdk.Cursor(gtk.gdk.WATCH)
+            self.ui.busy_bar.show()
+            self._busy_timer = gobject.timeout_add(100, self._pulse_busy_bar)
+        else:
+            cursor = None
+            self.ui.busy_bar.hide()
+            gobject.source_remove(self._busy_timer)
+            self._busy_timer = None
+        window = self.ui.main_window.window
+        if window is not None:
+            window.set_cursor(cursor)
+        self._update_action_states()
+
+    def _pulse_busy_bar(self):
+        self.ui.busy_bar.pulse()
+        return True
+
+    def _run_job(self, func, args):
+        result = func(*args)
+        # Rebuild the cached list of rules here rather than in the main loop
+        self.get_rules()
+        return result
+
+    def _call(self, func, *args):
+        """Run func(*args) on the worker thread and return its result
+
+        Exceptions are raised again here. The main loop keeps running until
+        func returns, so the window is still redrawn and events are shown,
+        but the busy bar holds the grab meanwhile, as a modal dialog would.
+        No other widget, of any window, gets any input, so no handler can
+        start another call or read the backend while it changes.
+        """
+        done = []
+        self._worker.submit(self._run_job, (func, args),
+                            lambda result: done.append((result, None)),
+                            lambda error: done.append((None, error)))
+        self.ui.busy_bar.grab_add()
+        try:
+            while not done:
+                gtk.main_iteration()
+        finally:
+            self.ui.busy_bar.grab_remove()
+        result, error = done[0]
+        if error is not None:
+            raise error
+        return result
 
     def _get_combobox_values(self, name):
         model = self.ui.get_object(name).get_model()
@@ -213,21 +457,334 @@ class GtkFrontend(Frontend):
         md.destroy()
         return res
 
-    def _update_conns_model(self):
-        self.ui.conns_model.clear()
-        gfw.util.get_connections(self.ui.conns_model.append)
+    def _add_events(self, events, notify=True):
+        #if notify:
+            #n = pynotify.Notification(_('Firewall'), _('Blocked incoming connection from %s') % (events[-1].src, ), gtk.STOCK_INFO)
+            #n.show()
+        self._events.extend(events)
+        self._events_pending += len(events)
+        if self._store is not None:
+            self._store.add(events, not notify)
+        # Only count live events, not the ones read back from the log
+        if notify:
+            self._talkers.add_events(events)
+        if self._events_timer is None:
+            interval = 1000 // self.EVENTS_REFRESH_RATE
+            self._events_timer = gobject.timeout_add(interval,
+                                                     self._update_events_model)
+
+    def _set_events_rows(self, events):
+        model = self.ui.events_model
+        view = self.ui.events_view
+        view.set_model(None)
+        model.clear()
+        for event in events:
+            model.append(event)
+        view.set_model(model)
+
+    def _update_events_model(self):
+        model = self.ui.events_model
+        view = self.ui.events_view
+        new = min(self._events_pending, len(self._events))
+        self._events_pending = 0
+        self._events_timer = None
+        if not self._events_live:
+            # Showing query results; catch up when going back to live view
+            return False
+        # Rows which have since been pushed out of the ring buffer
+        old = len(model) + new - len(self._events)
+        bulk = (old + new > self.BULK_UPDATE_ROWS)
+        if bulk:
+            view.set_model(None)
+        if old >= len(model):
+            model.clear()
+        else:
+            for i in xrange(old):
+                model.remove(model.get_iter_first())
+        for event in islice(self._events, len(self._events) - new, None):
+            model.append(event)
+        if bulk:
+            view.set_model(model)
+        return False
+
+    def _parse_events_query(self, text):
+        """Returns the source network and the destination port in text"""
+        src = None
+        dpt = None
+        for term in text.split():
+            if term.isdigit():
+                dpt = int(term)
+            else:
+                # Raises ValueError if not an address
+                gfw.util.parse_addr(term)
+                src = term
+        return (src, dpt)
+
+    def _get_talkers_row(self, key, count):
+        if self._talkers_group == 'src':
+            return (key, '', count)
+        elif self._talkers_group == 'port':
+            port, proto = key
+            if port:
+                port = '%s/%s' % (port, proto)
+            else:
+                port = proto
+            return ('', port, count)
+        else:
+            return (key[0], key[1], count)
+
+    def _update_talkers_model(self):
+        self._talkers.expire()
+        model = self.ui.talkers_model
+        rows = self._talkers_rows
+        for group, counter in self._talkers.counters.iteritems():
+            changed = counter.pop_changed()
+            if group != self._talkers_group:
+                continue
+            for key, count in changed:
+                itr = rows.get(key)
+                if not count:
+                    if itr is not None:
+                        model.remove(itr)
+                        del rows[key]
+                elif itr is None:
+                    rows[key] = model.append(self._get_talkers_row(key, count))
+                else:
+                    model.set_value(itr, 2, count)
+        return True
+
+    def _get_conns(self):
+        groups = gfw.aggregate.group_connections(gfw.util.get_connections(),
+                                                 gfw.util.get_local_addresses())
+        rows = {}
+        for key, conns in groups.iteritems():
+            proto, src, dst, dport = key
+            rows[key] = (proto, src, '', dst, dport, len(conns))
+        return (groups, rows)
+
+    def _refresh_conns(self):
+        # Reading and grouping all the tracked connections takes a while, so
+        # it is done on the worker; skip a refresh while one is running
+        if not self._conns_pending:
+            self._conns_pending = True
+            self._worker.submit(self._get_conns, callback=self._set_conns,
+                                errback=self._set_conns_failed,
+                                background=True)
         return True
 
+    def _set_conns_failed(self, error):
+        self._conns_pending = False
+
+    def _set_conns(self, result):
+        self._conns_pending = False
+        groups, rows = result
+        diff = gfw.util.diff_keys(self._conns_rows, rows)
+        changed = len(diff[0]) + len(diff[1])
+        diffs = {}
+        for key, conns in groups.iteritems():
+            children = self._conns_children.get(key, {})
+            diffs[key] = gfw.util.diff_keys(children, conns)
+            changed += len(diffs[key][1])
+        view = self.ui.conns_view
+        model = self.ui.conns_model
+        bulk = (changed > self.BULK_UPDATE_ROWS)
+        if bulk:
+            # Detaching the model collapses all rows
+            expanded = []
+            view.map_expanded_rows(lambda view, path: expanded.append(
+                    model.get(model.get_iter(path), 0, 1, 3, 4)))
+            view.set_model(None)
+        for key in diff[0]:
+            del self._conns_children[key]
+        gfw.util.sync_keyed_model(model, self._conns_rows, rows, diff)
+        for key, conns in groups.iteritems():
+            itr = self._conns_rows[key]
+            children = self._conns_children.setdefault(key, {})
+            removed, added = diffs[key]
+            if not removed and not added:
+                continue
+            model.set_value(itr, 5, len(conns))
+            new = {}
+            for conn in added:
+                new[conn] = conn + (1, )
+            gfw.util.sync_keyed_model(model, children, new, diffs[key], itr)
+        if bulk:
+            view.set_model(model)
+            for key in expanded:
+                if key in self._conns_rows:
+                    path = model.get_path(self._conns_rows[key])
+                    view.expand_row(path, False)
+
     def _update_rules_model(self):
-        self.ui.rules_model.clear()
+        rows = []
         for i, data in enumerate(self.get_rules()):
             idx, r = data
             r = gfw.util.get_formatted_rule(r)
-            row = (i + 1, r.action, r.direction, r.protocol, r.src, r.sport,
-                    r.dst, r.dport, idx)
-            self.ui.rules_model.append(row)
+            row = (str(i + 1), r.action, r.direction, r.protocol, r.src,
+                    r.sport, r.dst, r.dport, idx)
+            rows.append(row + self._get_analysis_columns(i) +
+                        self._get_counter_columns(idx))
+        # Rows are matched on everything except their number and position
+        diff = gfw.util.diff_rows(self._rules_rows, rows, lambda r: r[1:8])
+        start, old_end, new_end, order = diff
+        view = self.ui.rules_view
+        model = self.ui.rules_model
+        bulk = (old_end - start + new_end - start > self.BULK_UPDATE_ROWS)
+        if bulk:
+            # Avoid per-row signals to the view; restore its state afterwards
+            selected = self._get_selected_rows()
+            scroll = view.get_vadjustment().get_value()
+            view.set_model(None)
+        view.freeze_child_notify()
+        try:
+            gfw.util.sync_list_model(model, self._rules_rows, rows, diff)
+        finally:
+            view.thaw_child_notify()
+            if bulk:
+                view.set_model(self.ui.rules_sort)
+                self._select_rules([i for i in selected if i < len(rows)])
+                view.get_vadjustment().set_value(scroll)
+        self._rules_rows = rows
+        self._rules_index = None
+        if self._rules_visible is not None:
+            self._filter_rules()
+        self._refresh_analysis()
+
+    def _get_analysis_columns(self, i):
+        if self._analysis_generation != self.generation:
+            return (None, None)
+        found = self._analysis.get(i)
+        if found is None:
+            return (None, None)
+        kind, other = found
+        return (self.ANALYSIS_COLORS[kind],
+                _(self.ANALYSIS_TOOLTIPS[kind]) % (other + 1, ))
+
+    def _analyze(self):
+        generation = self.generation
+        rules = self.get_rules()
+        return (generation, gfw.analyze.analyze([r for idx, r in rules]))
+
+    def _refresh_analysis(self):
+        # Analyze each generation of the ruleset once
+        generation = self.generation
+        if generation in (self._analysis_generation, self._analysis_pending):
+            return
+        self._analysis_pending = generation
+        self._worker.submit(self._analyze, callback=self._set_analysis,
+                            errback=self._set_analysis_failed,
+                            background=True)
+
+    def _set_analysis_failed(self, error):
+        self._analysis_pending = None
+
+    def _set_analysis(self, result):
+        generation, analysis = result
+        if self._analysis_pending == generation:
+            self._analysis_pending = None
+        if generation != self.generation:
+            # The rules changed meanwhile
+            return
+        self._analysis = analysis
+        self._analysis_generation = generation
+        model = self.ui.rules_model
+        for i, row in enumerate(self._rules_rows):
+            columns = self._get_analysis_columns(i)
+            if row[9:11] != columns:
+                row = row[:9] + columns + row[11:]
+                self._rules_rows[i] = row
+                model[i] = row
+
+    def _get_counter_columns(self, idx):
+        counters = None
+        if self._counters_generation == self.generation:
+            counters = self._counters.get(idx)
+        if counters is None:
+            return (0, 0, 0.0, '', '', '')
+        packets, bytes, rate = counters
+        rate_text = ''
+        if rate is not None:
+            rate_text = '%.1f/s' % (rate, )
+        return (packets, bytes, rate or 0.0, str(packets),
+                gfw.util.get_formatted_size(bytes), rate_text)
+
+    def _get_counters(self):
+        return (self.generation, time.time(), self.get_rule_counters())
+
+    def _refresh_counters(self):
+        # Each refresh runs iptables-save, so only count while the rules are
+        # shown
+        if self.ui.view.get_current_page() == self.RULES_PAGE:
+            self._count_rules()
+        return True
+
+    def _count_rules(self):
+        # Skip a refresh while the last one or a change is still running
+        if not self._counters_pending and not self._worker.busy:
+            self._counters_pending = True
+            self._worker.submit(self._get_counters,
+                                callback=self._set_counters,
+                                errback=self._set_counters_failed,
+                                background=True)
+
+    def _set_counters_failed(self, error):
+        self._counters_pending = False
+
+    def _set_counters(self, result):
+        self._counters_pending = False
+        generation, now, counters = result
+        if generation != self.generation:
+            # The rules changed meanwhile
+            return
+        previous = {}
+        if self._counters_generation == generation:
+            previous = self._counters
+            elapsed = now - self._counters_time
+        new = {}
+        for (idx, r), c in zip(self.get_rules(), counters):
+            if c is None:
+                continue
+            packets, bytes = c
+            rate = None
+            old = previous.get(idx)
+            # Counters start over when the rules are reloaded
+            if old is not None and elapsed > 0 and packets >= old[0]:
+                rate = (packets - old[0]) / elapsed
+            new[idx] = (packets, bytes, rate)
+        self._counters = new
+        self._counters_generation = generation
+        self._counters_time = now
+        model = self.ui.rules_model
+        for i, row in enumerate(self._rules_rows):
+            columns = self._get_counter_columns(row[8])
+            if row[11:] != columns:
+                row = row[:11] + columns
+                self._rules_rows[i] = row
+                model[i] = row
+
+    def _is_rule_visible(self, model, itr):
+        if self._rules_visible is None:
+            return True
+        return model.get_value(itr, 8) in self._rules_visible
+
+    def _filter_rules(self):
+        """Show only the rules matching the query of the filter bar"""
+        query = self.ui.rules_filter_entry.get_text().strip()
+        if not query:
+            if self._rules_visible is None:
+                return
+            self._rules_visible = None
+        else:
+            if self._rules_index is None:
+                entries = []
+                for row, data in zip(self._rules_rows, self.get_rules()):
+                    entries.append((row[8], data[1], row[1:8]))
+                self._rules_index = gfw.search.RulesIndex(entries)
+            self._rules_visible = self._rules_index.search(query)
+        self.ui.rules_filter.refilter()
 
     def _update_apps_model(self):
+        self._apps_loaded = True
         self.ui.apps_model.clear()
         apps = self.backend.profiles.keys()
         apps.sort()
@@ -278,6 +835,7 @@ class GtkFrontend(Frontend):
         return rule
 
     def _restore_rule_dialog_defaults(self):
+        self._init_apps_model()
         # Max value should not exceed 'number of rules + 1'
         self.ui.position_adjustment.set_upper(len(self.ui.rules_model) + 1)
         # Always set to the value of the currently selected row
@@ -355,11 +913,37 @@ class GtkFrontend(Frontend):
             self.ui.dst_port_custom_rbutton.set_active(True)
             self.ui.dst_port_custom_entry.set_text(rule.dport)
 
+    def _get_model_row(self, path):
+        """Returns the position in rules_model of a path of rules_view"""
+        path = self.ui.rules_sort.convert_path_to_child_path(path)
+        return self.ui.rules_filter.convert_path_to_child_path(path)[0]
+
+    def _get_selected_rows(self):
+        """Returns the positions in rules_model of the selected rows"""
+        paths = self._selection.get_selected_rows()[1]
+        return sorted(self._get_model_row(path) for path in paths)
+
+    def _is_rules_sorted(self):
+        """Whether the rules are shown in another order than their own"""
+        column = self.ui.rules_sort.get_sort_column_id()
+        return column not in ((None, None), (8, gtk.SORT_ASCENDING))
+
     def _get_selected_rule_pos(self):
-        model, itr = self._selection.get_selected()
-        if not itr:
+        rows = self._get_selected_rows()
+        if not rows:
             return 0
-        return model.get_path(itr)[0] + 1
+        return rows[0] + 1
+
+    def _select_rules(self, rows):
+        """Select the rows of rules_model at the given positions"""
+        self._selection.unselect_all()
+        to_path = self.ui.rules_filter.convert_child_path_to_path
+        for i in rows:
+            path = to_path((i, ))
+            # None if the row is filtered out
+            if path is not None:
+                path = self.ui.rules_sort.convert_child_path_to_path(path)
+                self._selection.select_path(path)
 
     def _create_file_chooser_dialog(self, save=True):
         if save:
@@ -409,7 +993,7 @@ class GtkFrontend(Frontend):
             if chooser.run() == gtk.RESPONSE_OK:
                 filename = chooser.get_filename()
                 try:
-                    self.import_rules(filename)
+                    t = self._call(self.import_rules, filename, True)
                 except IOError as e:
                     self._show_dialog(e.strerror, chooser)
                     continue
@@ -417,12 +1001,17 @@ class GtkFrontend(Frontend):
                     self._show_dialog(e.value, chooser)
                     continue
                 else:
-                    self._set_statusbar_text(_('Rules imported'))
+                    msg = _('Rules imported (parse %.2fs, write %.2fs, apply %.2fs)')
+                    self._set_statusbar_text(msg % (t['parse'], t['write'], t['apply']))
             break
         chooser.destroy()
         self._update_rules_model()
 
     def on_quit_activate(self, action):
+        if self._store is not None:
+            # Write out the events buffered since the last flush
+            self._store.close()
+            self._store = None
         gtk.main_quit()
 
     def on_prefs_dialog_show_activate(self, action):
@@ -430,41 +1019,44 @@ class GtkFrontend(Frontend):
         if self.ui.prefs_dialog.run() == self.RESPONSE_OK:
             # loglevel
             level = self._get_combobox_value('logging_cbox').lower()
-            self.set_loglevel(level)
             # default incoming
-            policy = self._get_combobox_value('incoming_policy_cbox').lower()
-            self.backend.set_default_policy(policy, 'incoming')
+            incoming = self._get_combobox_value('incoming_policy_cbox').lower()
             # default outgoing
-            policy = self._get_combobox_value('outgoing_policy_cbox').lower()
-            self.backend.set_default_policy(policy, 'outgoing')
+            outgoing = self._get_combobox_value('outgoing_policy_cbox').lower()
             # enable IPv6?
-            self.config_ipv6(self.ui.enable_ipv6.get_active())
+            ipv6 = self.ui.enable_ipv6.get_active()
             # Enable additional IPT modules?
-            # FTP
-            self.config_ipt_module('nf_conntrack_ftp',
-                                   self.ui.mod_ftp_chkbox.get_active())
-            self.config_ipt_module('nf_nat_ftp',
-                                   self.ui.mod_ftp_chkbox.get_active())
-            # IRC
-            self.config_ipt_module('nf_conntrack_irc',
-                                   self.ui.mod_irc_chkbox.get_active())
-            self.config_ipt_module('nf_nat_irc',
-                                   self.ui.mod_irc_chkbox.get_active())
-            # NetBIOS
-            self.config_ipt_module('nf_conntrack_netbios_ns',
-                                   self.ui.mod_netbios_chkbox.get_active())
-            # PPTP
-            self.config_ipt_module('nf_conntrack_pptp',
-                                   self.ui.mod_pptp_chkbox.get_active())
-            # saned
-            self.config_ipt_module('nf_conntrack_sane',
-                                   self.ui.mod_saned_chkbox.get_active())
-            # reload firewall
-            self.reload()
-            self._set_statusbar_text(_('Preferences saved'))
+            modules = [
+                # FTP
+                ('nf_conntrack_ftp', self.ui.mod_ftp_chkbox.get_active()),
+                ('nf_nat_ftp', self.ui.mod_ftp_chkbox.get_active()),
+                # IRC
+                ('nf_conntrack_irc', self.ui.mod_irc_chkbox.get_active()),
+                ('nf_nat_irc', self.ui.mod_irc_chkbox.get_active()),
+                # NetBIOS
+                ('nf_conntrack_netbios_ns',
+                 self.ui.mod_netbios_chkbox.get_active()),
+                # PPTP
+                ('nf_conntrack_pptp', self.ui.mod_pptp_chkbox.get_active()),
+                # saned
+                ('nf_conntrack_sane', self.ui.mod_saned_chkbox.get_active()),
+            ]
+            # Save only what changed, and reload the firewall if needed
+            policies = {'incoming': incoming, 'outgoing': outgoing}
+            changed = self._call(self.set_preferences, level, policies, ipv6,
+                                 modules)
+            if changed:
+                self._set_statusbar_text(_('Preferences saved'))
+            else:
+                self._set_statusbar_text(_('No preferences changed'))
         self.ui.prefs_dialog.hide()
 
     def on_reports_dialog_show_activate(self, action):
+        # Prefetch the reports so that switching between them is instant
+        for row in self.ui.reports_model:
+            report = row[0].split('-')[0]
+            self._worker.submit(self.get_report, (report, ),
+                                errback=lambda e: None, background=True)
         self.ui.reports_dialog.run()
         self.ui.reports_dialog.hide()
         # Reset
@@ -473,17 +1065,56 @@ class GtkFrontend(Frontend):
 
     def on_report_cbox_changed(self, widget):
         active = widget.get_active()
+        if active < 0:
+            return
         model = widget.get_model()
         report = model[active][0].split('-')[0]
-        if report != 'listening':
+        res = self.get_cached_report(report)
+        if res is None:
             try:
-                res = self.get_show_raw(report)
+                res = self._call(self.get_report, report)
             except UFWError:
                 res = ''
-        else:
-            res = self.get_show_listening()
+            if widget.get_active() != active:
+                # Another report was selected meanwhile
+                return
         self.ui.reports_buffer.set_text(res)
 
+    def on_diagnostics_dialog_show_activate(self, action):
+        dlg = self.ui.diagnostics_dialog
+        while True:
+            self.ui.diagnostics_buffer.set_text(self._instrument.format())
+            response = dlg.run()
+            if response == self.RESPONSE_SAVE:
+                self._save_diagnostics()
+            elif response != self.RESPONSE_REFRESH:
+                break
+        dlg.hide()
+
+    def _save_diagnostics(self):
+        buttons = (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                    gtk.STOCK_SAVE_AS, gtk.RESPONSE_OK)
+        chooser = gtk.FileChooserDialog(_('Save Diagnostics'),
+                self.ui.diagnostics_dialog, gtk.FILE_CHOOSER_ACTION_SAVE,
+                buttons)
+        chooser.set_current_name('ufw-gtk-diagnostics.json')
+        while chooser.run() == gtk.RESPONSE_OK:
+            try:
+                self._instrument.dump(chooser.get_filename())
+            except IOError as e:
+                self._show_dialog(e.strerror, chooser)
+                continue
+            self._set_statusbar_text(_('Diagnostics saved'))
+            break
+        chooser.destroy()
+
+    def on_profile_button_clicked(self, widget):
+        name = self._get_combobox_value('operation_cbox')
+        if name is not None:
+            self._instrument.profile_next(name)
+            msg = _('The next call of %s will be profiled') % (name, )
+            self._set_statusbar_text(msg)
+
     def on_about_dialog_show_activate(self, action):
         self.ui.about_dialog.run()
         self.ui.about_dialog.hide()
@@ -491,26 +1122,33 @@ class GtkFrontend(Frontend):
     # ------------------------ Firewall Actions ------------------------
 
     def on_firewall_toggle_toggled(self, action):
-        res = self.set_enabled(not self.backend._is_enabled())
+        res = self._call(self.set_enabled, not self.backend._is_enabled())
         self._set_statusbar_text(res)
         self._update_action_states()
 
     def on_firewall_reload_activate(self, action):
-        if self.reload():
+        res = self._call(self.reload)
+        if res:
             self._update_rules_model()
-            self._set_statusbar_text(_('Firewall reloaded'))
+            if res['method'] == 'skip':
+                msg = _('Firewall is up to date (checked in %.2fs)')
+            elif res['method'] == 'restore':
+                msg = _('Firewall reloaded in %.2fs')
+            else:
+                msg = _('Firewall reloaded in %.2fs (full reload)')
+            self._set_statusbar_text(msg % (res['time'], ))
 
     def on_firewall_reset_activate(self, action):
         msg = _('Resetting all rules to installed defaults.\nProceed with operation?')
         res = self._show_dialog(msg, type=gtk.MESSAGE_WARNING, buttons=gtk.BUTTONS_YES_NO)
         if res == gtk.RESPONSE_YES:
-            self.reset(True)
-            self.ui.rules_model.clear()
+            self._call(self.reset, True)
+            self._update_rules_model()
             self._update_action_states()
             self._set_statusbar_text(_('Firewall defaults restored'))
 
     def on_firewall_update_activate(self, action):
-        res = self.application_update('all')
+        res = self._call(self.application_update, 'all')
         if not res:
             res = _('Nothing to update')
         self._show_dialog(res, type=gtk.MESSAGE_INFO)
@@ -529,7 +1167,7 @@ class GtkFrontend(Frontend):
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
                 try:
-                    res = self.set_rule(rule)
+                    res = self._call(self.set_rule, rule)
                 except UFWError as e:
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
@@ -555,13 +1193,13 @@ class GtkFrontend(Frontend):
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
                 try:
-                    self.update_rule(pos, rule)
+                    self._call(self.update_rule, pos, rule)
                 except UFWError as e:
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
                 self._set_statusbar_text(_('Rule updated'))
                 self._update_rules_model()
-                self._selection.select_path(pos - 1)
+                self._select_rules([pos - 1])
             break
         self.ui.rule_dialog.hide()
 
@@ -577,7 +1215,7 @@ class GtkFrontend(Frontend):
         if res == gtk.RESPONSE_NO:
             return
         try:
-            res = self.delete_rule(pos, True)
+            res = self._call(self.delete_rule, pos, True)
         except UFWError as e:
             self._show_dialog(e.value)
         else:
@@ -593,9 +1231,9 @@ class GtkFrontend(Frontend):
         new = pos - 1
         if new < 1:
             return
-        self.move_rule(pos, new)
+        self._call(self.move_rule, pos, new)
         self._update_rules_model()
-        self._selection.select_path(new - 1)
+        self._select_rules([new - 1])
 
     def on_rule_down_activate(self, action):
         if not self.backend._is_enabled():
@@ -606,9 +1244,9 @@ class GtkFrontend(Frontend):
         new = pos + 1
         if new > len(self.ui.rules_model):
             return
-        self.move_rule(pos, new)
+        self._call(self.move_rule, pos, new)
         self._update_rules_model()
-        self._selection.select_path(new - 1)
+        self._select_rules([new - 1])
 
     # ------------------------- Event Actions --------------------------
 
@@ -642,7 +1280,7 @@ class GtkFrontend(Frontend):
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
                 try:
-                    res = self.set_rule(rule)
+                    res = self._call(self.set_rule, rule)
                 except UFWError as e:
                     self._show_dialog(e.value, self.ui.rule_dialog)
                     continue
@@ -663,18 +1301,131 @@ class GtkFrontend(Frontend):
         # Show popup on right-click only
         if event.button == 3:
             self.ui.rule_menu.popup(None, None, None, event.button, event.time)
+        elif event.button == 1:
+            if event.state & (gtk.gdk.CONTROL_MASK | gtk.gdk.SHIFT_MASK):
+                return
+            res = widget.get_path_at_pos(int(event.x), int(event.y))
+            if res is not None and self._selection.path_is_selected(res[0]):
+                # Keep the current selection in case this starts a drag
+                self._selection.set_select_function(lambda *args: False)
+                self._pending_select = res[0]
+
+    def _finish_pending_select(self):
+        self._selection.set_select_function(lambda *args: True)
+        path = self._pending_select
+        self._pending_select = None
+        return path
+
+    def on_rules_view_button_release_event(self, widget, event):
+        if self._pending_select is not None:
+            # Not a drag after all; select just the clicked row
+            path = self._finish_pending_select()
+            self._selection.unselect_all()
+            self._selection.select_path(path)
+
+    def on_rules_view_drag_end(self, widget, context):
+        self._finish_pending_select()
+
+    def on_rules_view_drag_data_get(self, widget, context, selection, info,
+                                    timestamp):
+        data = ' '.join(str(i) for i in self._get_selected_rows())
+        selection.set(selection.target, 8, data)
+        widget.emit_stop_by_name('drag-data-get')
+
+    def on_rules_view_drag_data_received(self, widget, context, x, y,
+                                         selection, info, timestamp):
+        widget.emit_stop_by_name('drag-data-received')
+        context.finish(True, False, timestamp)
+        if not selection.data or self._worker.busy:
+            return
+        if self._is_rules_sorted():
+            self._set_statusbar_text(_('Sort the rules by number to move '
+                                       'them'))
+            return
+        rows = map(int, selection.data.split())
+        n = len(self.ui.rules_model)
+        drop = widget.get_dest_row_at_pos(x, y)
+        if drop is None:
+            dest = n
+        else:
+            path, position = drop
+            # Hidden rows keep their place relative to the visible ones
+            dest = self._get_model_row(path)
+            if position in (gtk.TREE_VIEW_DROP_AFTER,
+                            gtk.TREE_VIEW_DROP_INTO_OR_AFTER):
+                dest += 1
+        moved = set(rows)
+        order = [i for i in xrange(n) if i not in moved]
+        # Drop position among the rows which are not moved
+        dest -= len([i for i in rows if i < dest])
+        order[dest:dest] = rows
+        try:
+            self._call(self.reorder_rules, order)
+        except UFWError as e:
+            self._show_dialog(e.value)
+            return
+        self._update_rules_model()
+        self._select_rules(range(dest, dest + len(rows)))
+        self._set_statusbar_text(_('Rules moved'))
+
+    def on_rules_filter_entry_changed(self, widget):
+        self._filter_rules()
+
+    def on_rules_filter_entry_icon_press(self, widget, icon_pos, event):
+        widget.set_text('')
 
     def on_events_view_button_press_event(self, widget, event):
         # Show popup on right-click only
         if event.button == 3:
             self.ui.event_menu.popup(None, None, None, event.button, event.time)
 
+    def on_events_query_changed(self, widget):
+        span = self.EVENTS_RANGES[self.ui.events_range_cbox.get_active()]
+        text = self.ui.events_query_entry.get_text().strip()
+        if span is None and not text:
+            self._events_live = True
+            self._events_pending = 0
+            self._set_events_rows(self._events)
+            return
+        try:
+            src, dpt = self._parse_events_query(text)
+        except ValueError:
+            self._set_statusbar_text(_('Invalid query: %s') % (text, ))
+            return
+        since = (time.time() - span if span else None)
+        start = time.time()
+        self._store.flush()
+        events = self._store.query(src, dpt, since, limit=self._max_events)
+        self._events_live = False
+        self._set_events_rows(events)
+        msg = _('%d events found in %.0f ms') % (len(events),
+                                                (time.time() - start) * 1000)
+        self._set_statusbar_text(msg)
+
+    def on_talkers_cbox_changed(self, widget):
+        group = gfw.aggregate.TopTalkers.GROUPS[widget.get_active()]
+        self._talkers_group = group
+        model = self.ui.talkers_model
+        self.ui.talkers_view.set_model(None)
+        model.clear()
+        self._talkers_rows = {}
+        counter = self._talkers.counters[group]
+        counter.pop_changed()
+        for key, count in counter.totals.iteritems():
+            row = self._get_talkers_row(key, count)
+            self._talkers_rows[key] = model.append(row)
+        self.ui.talkers_view.set_model(model)
+
     def on_view_switch_page(self, widget, page, page_num):
-        if page_num == 2:
-            self._update_conns_model()
-            self._conn_timer = gobject.timeout_add_seconds(5, self._update_conns_model)
+        # The page is only switched after this handler
+        if page_num == self.RULES_PAGE and self._counters_interval > 0:
+            self._count_rules()
+        if page_num == 2 and self._conn_timer is None:
+            self._refresh_conns()
+            self._conn_timer = gobject.timeout_add_seconds(5, self._refresh_conns)
         elif self._conn_timer is not None:
             gobject.source_remove(self._conn_timer)
+            self._conn_timer = None
 
     # --------------------- Rule Dialog Callbacks ----------------------
 
@@ -747,8 +1498,33 @@ class GtkFrontend(Frontend):
 
 
 def main():
+    parser = OptionParser()
+    parser.add_option('--event-store', metavar='PATH',
+                      help=_('keep blocked events in an SQLite database'))
+    parser.add_option('--startup-timing', action='store_true', default=False,
+                      help=_('print the time taken by each startup phase'))
+    parser.add_option('--instrument', action='store_true', default=False,
+                      help=_('record statistics of the firewall operations'))
+    parser.add_option('--counters-interval', type='int', metavar='SECONDS',
+                      help=_('refresh the rule hit counters every SECONDS '
+                             'seconds while the rules are shown, or never if '
+                             '0 (default: %d)') %
+                           (GtkFrontend.COUNTERS_INTERVAL, ))
+    parser.add_option('--backfill-events', type='int', metavar='N',
+                      help=_('show the last N blocked events of the log on '
+                             'startup (default: %d)') %
+                           (GtkFrontend.BACKFILL_EVENTS, ))
+    parser.add_option('--max-events', type='int', metavar='N',
+                      help=_('keep the last N blocked events in the events '
+                             'view (default: %d)') %
+                           (GtkFrontend.MAX_EVENTS, ))
+    options, args = parser.parse_args()
+    # The worker thread hands results back through gobject.idle_add
+    gobject.threads_init()
     try:
-        ui = GtkFrontend()
+        ui = GtkFrontend(options.event_store, options.startup_timing,
+                         options.instrument, options.counters_interval,
+                         options.backfill_events, options.max_events)
     except UFWError as e:
         sys.exit(e.value)
     else:
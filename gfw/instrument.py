@@ -0,0 +1,252 @@
+#
+# instrument.py: Statistics of backend operations
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import json
+import os.path
+import pstats
+import subprocess
+import threading
+import time
+from cStringIO import StringIO
+
+
+# Operations of gfw.frontend.Frontend which are instrumented
+OPERATIONS = ('set_rule', 'update_rule', 'delete_rule', 'reorder_rules',
+              'set_enabled', 'reload', 'export_rules', 'import_rules')
+
+# Upper bounds of the buckets of the wall time histograms, in seconds
+BUCKETS = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, float('inf'))
+
+
+_BUCKET_LABELS = ['<%gs' % (b, ) for b in BUCKETS[:-1]]
+_BUCKET_LABELS.append('>=%gs' % (BUCKETS[-2], ))
+
+
+def _get_bytes_written():
+    """Returns the number of bytes written by this process so far
+
+    Includes writes to pipes, e.g. to iptables-restore, and those of all
+    threads. Returns None if /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+_Popen_orig = subprocess.Popen
+
+
+class _Popen(_Popen_orig):
+    """subprocess.Popen which counts the iptables commands it runs, for each
+    thread
+    """
+
+    counts = threading.local()
+
+    def __init__(self, args, *rest, **kwargs):
+        if isinstance(args, basestring):
+            exe = args.split(None, 1)[0]
+        else:
+            exe = args[0]
+        if 'tables' in os.path.basename(exe):
+            # iptables, ip6tables, iptables-restore, ...
+            _Popen.counts.iptables_calls = _get_iptables_calls() + 1
+        super(_Popen, self).__init__(args, *rest, **kwargs)
+
+
+def _get_iptables_calls():
+    """Returns the number of iptables commands run by this thread so far"""
+    return getattr(_Popen.counts, 'iptables_calls', 0)
+
+
+# Number of wrapped calls running, on any thread, while subprocess.Popen is
+# replaced by _Popen
+_patch_lock = threading.Lock()
+_patch_users = 0
+
+
+def _patch_popen():
+    global _patch_users
+    with _patch_lock:
+        if not _patch_users:
+            subprocess.Popen = _Popen
+        _patch_users += 1
+
+
+def _unpatch_popen():
+    global _patch_users
+    with _patch_lock:
+        _patch_users -= 1
+        if not _patch_users:
+            subprocess.Popen = _Popen_orig
+
+
+class Stats(object):
+    """Statistics of the calls of one operation"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.iptables_calls = 0
+        self.bytes_written = 0
+        self.histogram = [0] * len(BUCKETS)
+
+    def add(self, t, iptables_calls, bytes_written, failed):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.time += t
+        self.max_time = max(self.max_time, t)
+        self.iptables_calls += iptables_calls
+        self.bytes_written += bytes_written
+        for i, bound in enumerate(BUCKETS):
+            if t < bound:
+                self.histogram[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'time': self.time,
+            'max_time': self.max_time,
+            'iptables_calls': self.iptables_calls,
+            'bytes_written': self.bytes_written,
+            'histogram': dict(zip(_BUCKET_LABELS, self.histogram)),
+        }
+
+
+class Instrument(object):
+    """Records statistics of the operations of a frontend
+
+    attach() replaces the operations of the frontend with wrappers which
+    record the wall time, the number of iptables commands run and the bytes
+    written by each call. Nested operations, e.g. the set_rule calls of
+    import_rules, are recorded under their own names too. The operations
+    may run on another thread than the one reading the statistics.
+
+    subprocess.Popen is only replaced while a wrapped call runs, and only
+    the iptables commands run by the thread of the call are counted. The
+    bytes written are those of the whole process meanwhile, so they
+    include any writes of other threads, e.g. of the event store.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+        # Operation name -> profile text of its last profiled call
+        self.profiles = {}
+        self._profile_next = None
+
+    def attach(self, frontend, operations=OPERATIONS):
+        for name in operations:
+            func = getattr(frontend, name)
+            setattr(frontend, name, self._wrap(name, func))
+
+    def profile_next(self, name):
+        """Profile the next call of an operation with cProfile"""
+        self._profile_next = name
+
+    def _wrap(self, name, func):
+        def wrapper(*args, **kwargs):
+            return self._call(name, func, args, kwargs)
+        wrapper.__name__ = name
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def _call(self, name, func, args, kwargs):
+        profiler = None
+        if self._profile_next == name:
+            self._profile_next = None
+            profiler = cProfile.Profile()
+        # Count the iptables commands run by ufw and gfw
+        _patch_popen()
+        calls = _get_iptables_calls()
+        written = _get_bytes_written()
+        failed = True
+        start = time.time()
+        try:
+            if profiler is not None:
+                result = profiler.runcall(func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            t = time.time() - start
+            if written is not None:
+                written = _get_bytes_written() - written
+            calls = _get_iptables_calls() - calls
+            _unpatch_popen()
+            profile = None
+            if profiler is not None:
+                profile = self._format_profile(profiler)
+            with self._lock:
+                stats = self.stats.setdefault(name, Stats())
+                stats.add(t, calls, written or 0, failed)
+                if profile is not None:
+                    self.profiles[name] = profile
+
+    @staticmethod
+    def _format_profile(profiler, limit=30):
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def to_dict(self):
+        stats = {}
+        with self._lock:
+            for name, s in self.stats.iteritems():
+                stats[name] = s.to_dict()
+            profiles = dict(self.profiles)
+        return {'operations': stats, 'profiles': profiles}
+
+    def dump(self, path):
+        """Write the statistics and profiles to path as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def format(self):
+        """Returns the statistics as a text table"""
+        data = self.to_dict()
+        lines = ['%-14s %6s %6s %10s %10s %9s %10s' % ('operation', 'calls',
+                 'errors', 'mean ms', 'max ms', 'iptables', 'bytes')]
+        for name, s in sorted(data['operations'].iteritems()):
+            lines.append('%-14s %6d %6d %10.1f %10.1f %9d %10d' % (name,
+                         s['calls'], s['errors'], s['time'] / s['calls'] * 1000,
+                         s['max_time'] * 1000, s['iptables_calls'],
+                         s['bytes_written']))
+            hist = ['%s: %d' % (label, s['histogram'][label])
+                    for label in _BUCKET_LABELS if s['histogram'][label]]
+            lines.append('    ' + ', '.join(hist))
+        lines.append('bytes: written by the whole process during the calls, '
+                     'by any thread')
+        for name, profile in sorted(data['profiles'].iteritems()):
+            lines.append('')
+            lines.append('Profile of %s:' % (name, ))
+            lines.append(profile)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,168 @@
+#
+# iptables.py: Reading and applying iptables-save/iptables-restore data
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import subprocess
+
+from ufw.common import UFWError
+
+
+BUILTIN_CHAINS = frozenset(['INPUT', 'OUTPUT', 'FORWARD', 'PREROUTING',
+                            'POSTROUTING'])
+
+_re_counters = re.compile(r'^\[\d+:\d+\] ')
+
+# The counters, chain and target of a rule in iptables-save -c output
+_re_counted_rule = re.compile(r'^\[(\d+):(\d+)\] -A (\S+)(?:.* -j (\S+))?')
+
+
+class Table(object):
+    """The chains and rules of one table in iptables-restore format
+
+    chains is a list of (name, policy) in order of declaration, where the
+    policy of a user-defined chain is '-'. rules is a list of (chain, rule)
+    with the rules as in iptables-restore input, e.g. '-A INPUT -j DROP'.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.chains = []
+        self.rules = []
+
+    def get_chain_names(self):
+        return [c[0] for c in self.chains]
+
+    def get_chain_rules(self, chain):
+        return [r for c, r in self.rules if c == chain]
+
+
+def parse_tables(lines):
+    """Parse iptables-save output or iptables-restore input
+
+    Returns a list of Tables in the order they appear. Tables which appear
+    more than once are merged. Raises ValueError for invalid input.
+    """
+    tables = []
+    by_name = {}
+    table = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('*'):
+            name = line[1:]
+            table = by_name.get(name)
+            if table is None:
+                table = by_name[name] = Table(name)
+                tables.append(table)
+        elif line == 'COMMIT':
+            table = None
+        elif table is None:
+            raise ValueError('line outside of a table: %s' % (line, ))
+        elif line.startswith(':'):
+            fields = line[1:].split()
+            if len(fields) < 2:
+                raise ValueError('invalid chain: %s' % (line, ))
+            if fields[0] not in table.get_chain_names():
+                table.chains.append((fields[0], fields[1]))
+        else:
+            # Counters of iptables-save -c
+            line = _re_counters.sub('', line)
+            fields = line.split(None, 2)
+            if len(fields) < 2 or fields[0] not in ('-A', '-I'):
+                raise ValueError('invalid rule: %s' % (line, ))
+            table.rules.append((fields[1], line))
+    return tables
+
+
+def merge_tables(*sources):
+    """Merge lists of Tables, keeping the order of chains and rules"""
+    tables = []
+    by_name = {}
+    for source in sources:
+        for t in source:
+            table = by_name.get(t.name)
+            if table is None:
+                table = by_name[t.name] = Table(t.name)
+                tables.append(table)
+            names = table.get_chain_names()
+            table.chains.extend(c for c in t.chains if c[0] not in names)
+            table.rules.extend(t.rules)
+    return tables
+
+
+def format_tables(tables):
+    """Returns iptables-restore input for a list of Tables"""
+    lines = []
+    for table in tables:
+        lines.append('*%s' % (table.name, ))
+        for chain, policy in table.chains:
+            lines.append(':%s %s [0:0]' % (chain, policy))
+        lines.extend(r for c, r in table.rules)
+        lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_counters(lines, table='filter'):
+    """Parse the rule counters of one table in iptables-save -c output
+
+    Returns a dict of chain -> list of (packets, bytes, target) of its
+    rules, in order. target is None for rules which do not jump anywhere.
+    """
+    chains = {}
+    current = None
+    for line in lines:
+        if line.startswith('*'):
+            current = line.strip()[1:]
+        elif current == table:
+            m = _re_counted_rule.match(line)
+            if m is not None:
+                packets, bytes, chain, target = m.groups()
+                rule = (int(packets), int(bytes), target)
+                chains.setdefault(chain, []).append(rule)
+    return chains
+
+
+def save(exe, counters=False):
+    """Returns the output of exe, i.e. iptables-save or ip6tables-save
+
+    If counters is True, the packet and byte counters of each rule are
+    included, as by iptables-save -c.
+    """
+    args = [exe]
+    if counters:
+        args.append('-c')
+    p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise UFWError(_('%s failed: %s') % (exe, err.strip()))
+    return out
+
+
+def restore(exe, data):
+    """Apply data with exe --noflush
+
+    exe is iptables-restore or ip6tables-restore. Each table is replaced
+    atomically; chains which are declared in data are flushed first.
+    """
+    p = subprocess.Popen([exe, '-n'], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate(data)
+    if p.returncode != 0:
+        raise UFWError(_('%s failed: %s') % (exe, err.strip()))
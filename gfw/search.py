@@ -0,0 +1,183 @@
+#
+# search.py: Searching the rules
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import re
+
+from gfw.util import ANY_PORT, get_addr_range, parse_ports
+
+
+# Ranges of more ports than this are matched by scanning the index of single
+# ports instead of looking up each of their ports
+MAX_PORT_LOOKUPS = 1024
+
+# Words which may be used in queries for readability
+FILLER_WORDS = frozenset(['and', 'from', 'to', 'port', 'on'])
+
+_ANY_ADDRS = frozenset(['0.0.0.0/0', '::/0'])
+
+_re_ports = re.compile(r'^(\d+)(?:[:-](\d+))?$')
+
+
+def _get_prefix_length(first, last):
+    """Prefix length of a network returned by get_addr_range"""
+    size = last - first
+    bits = 0
+    while size:
+        size >>= 1
+        bits += 1
+    return 128 - bits
+
+
+class RulesIndex(object):
+    """Index of rules for queries by port, network and keyword
+
+    A query is a list of terms, all of which a rule has to match. Terms may
+    be joined with 'or', which binds less tightly. A term is:
+
+      * a port or a range of ports, e.g. 5432 or 6000:6007, matching the
+        rules for any of these source or destination ports
+      * an address or a network, e.g. 10.20.0.0/16, matching the rules for
+        source or destination networks which overlap it
+      * an action, direction or protocol, e.g. deny, out or udp
+      * any other text, matching rules whose fields contain it, e.g. an app
+        or interface name
+
+    Rules for any port or address are not matched by ports or networks.
+    Except for the text, each term is answered from the index rather than
+    by looking at every rule.
+    """
+
+    def __init__(self, rules):
+        """rules is a list of (key, UFWRule, fields), where fields are the
+        texts shown for the rule.
+        """
+        self.keys = set()
+        # Action, direction or protocol -> keys
+        self._words = {}
+        # Single port -> keys, and (first, last, key) of port ranges
+        self._ports = {}
+        self._port_ranges = []
+        # (prefix length, prefix) -> keys of a network, with IPv4 mapped
+        # into IPv6 as by get_addr_range
+        self._nets = {}
+        self._lengths = []
+        # First address and key of each network, sorted
+        self._net_starts = []
+        self._net_keys = []
+        self._texts = {}
+        starts = []
+        for key, rule, fields in rules:
+            self.keys.add(key)
+            for word in (rule.action, rule.direction, rule.protocol):
+                self._words.setdefault(word.lower(), set()).add(key)
+            for ports in (rule.sport, rule.dport):
+                if ports != ANY_PORT:
+                    self._add_ports(key, ports)
+            for addr in (rule.src, rule.dst):
+                if addr not in _ANY_ADDRS:
+                    self._add_net(key, addr, starts)
+            self._texts[key] = ' '.join(f for f in fields if f).lower()
+        starts.sort()
+        self._net_starts = [s[0] for s in starts]
+        self._net_keys = [s[1] for s in starts]
+        self._lengths.sort()
+
+    def _add_ports(self, key, ports):
+        try:
+            intervals = parse_ports(ports)
+        except ValueError:
+            # App name
+            return
+        for first, last in intervals:
+            if first == last:
+                self._ports.setdefault(first, set()).add(key)
+            else:
+                self._port_ranges.append((first, last, key))
+
+    def _add_net(self, key, addr, starts):
+        try:
+            first, last = get_addr_range(addr)
+        except ValueError:
+            return
+        plen = _get_prefix_length(first, last)
+        self._nets.setdefault((plen, first >> (128 - plen)), set()).add(key)
+        if plen not in self._lengths:
+            self._lengths.append(plen)
+        starts.append((first, key))
+
+    def _match_ports(self, first, last):
+        keys = set()
+        if last - first < MAX_PORT_LOOKUPS:
+            for port in xrange(first, last + 1):
+                keys.update(self._ports.get(port, ()))
+        else:
+            for port, port_keys in self._ports.iteritems():
+                if first <= port <= last:
+                    keys.update(port_keys)
+        for f, l, key in self._port_ranges:
+            if f <= last and first <= l:
+                keys.add(key)
+        return keys
+
+    def _match_net(self, first, last):
+        keys = set()
+        plen = _get_prefix_length(first, last)
+        # Networks containing the query
+        for length in self._lengths:
+            if length > plen:
+                break
+            keys.update(self._nets.get((length, first >> (128 - length)), ()))
+        # Networks within it, which all start within it
+        start = bisect.bisect_left(self._net_starts, first)
+        end = bisect.bisect_right(self._net_starts, last)
+        keys.update(self._net_keys[start:end])
+        return keys
+
+    def _match_term(self, term):
+        m = _re_ports.match(term)
+        if m is not None:
+            first = int(m.group(1))
+            last = (int(m.group(2)) if m.group(2) else first)
+            return self._match_ports(min(first, last), max(first, last))
+        if term in self._words:
+            return self._words[term]
+        if '.' in term or ':' in term:
+            try:
+                return self._match_net(*get_addr_range(term))
+            except ValueError:
+                pass
+        return set(k for k, text in self._texts.iteritems() if term in text)
+
+    def search(self, query):
+        """Returns the keys of the rules matching query"""
+        alternatives = [[]]
+        for term in query.lower().split():
+            if term == 'or':
+                alternatives.append([])
+            elif term not in FILLER_WORDS:
+                alternatives[-1].append(term)
+        result = set()
+        for terms in alternatives:
+            keys = self.keys
+            for term in terms:
+                keys = keys & self._match_term(term)
+                if not keys:
+                    break
+            result.update(keys)
+        return result
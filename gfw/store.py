@@ -0,0 +1,171 @@
+#
+# store.py: Persistent store of firewall events
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import time
+
+from gfw.event import Event
+from gfw.util import get_addr_range
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    timestamp TEXT,
+    event TEXT,
+    iface_in TEXT,
+    iface_out TEXT,
+    proto TEXT,
+    src TEXT,
+    src_key TEXT,
+    spt TEXT,
+    dst TEXT,
+    dpt INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_src ON events (src_key, time);
+CREATE INDEX IF NOT EXISTS events_dpt ON events (dpt, time);
+"""
+
+_COLUMNS = ', '.join(Event._fields)
+
+
+def _get_time(timestamp, now):
+    """Convert a syslog timestamp to seconds since the epoch"""
+    try:
+        # RFC 3164, e.g. 'Oct 18 10:00:00'; the year is not logged
+        t = time.strptime(timestamp, '%b %d %H:%M:%S')
+        t = time.mktime((time.localtime(now).tm_year, ) + t[1:8] + (-1, ))
+        # Allow for some clock skew, otherwise it was logged last year
+        if t > now + 86400:
+            t = time.mktime((time.localtime(now).tm_year - 1, ) +
+                            time.localtime(t)[1:8] + (-1, ))
+        return t
+    except ValueError:
+        pass
+    try:
+        # RFC 3339, e.g. '2026-10-18T10:00:00.123456+00:00 host kernel:'
+        t = time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+        return time.mktime(t[:8] + (-1, ))
+    except ValueError:
+        return now
+
+
+def _get_addr_key(addr):
+    try:
+        return '%032x' % (get_addr_range(addr)[0], )
+    except ValueError:
+        return None
+
+
+class EventStore(object):
+    """SQLite store of BLOCK events
+
+    Events are buffered by add() and written in one transaction by flush().
+    compact() enforces the retention policy: events older than retention
+    seconds are deleted, as are the oldest ones beyond max_events.
+    """
+
+    def __init__(self, path, retention=30 * 86400, max_events=1000000):
+        self.retention = retention
+        self.max_events = max_events
+        self._db = sqlite3.connect(path)
+        self._db.text_factory = str
+        # Must be set before the tables are created to take effect
+        self._db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(_SCHEMA)
+        self._pending = []
+        row = self._db.execute('SELECT MAX(time) FROM events').fetchone()
+        self._latest = row[0] or 0
+
+    def add(self, events, backfill=False, now=None):
+        """Buffer events for the next flush()
+
+        Events read back from the log on startup (backfill) are skipped if
+        they are older than the newest stored event, as they were stored
+        by a previous session.
+        """
+        if now is None:
+            now = time.time()
+        for e in events:
+            t = (_get_time(e.timestamp, now) if backfill else now)
+            if backfill and t < self._latest:
+                continue
+            dpt = (int(e.dpt) if e.dpt else None)
+            self._pending.append((t, e.timestamp, e.event, e.iface_in,
+                                  e.iface_out, e.proto, e.src,
+                                  _get_addr_key(e.src), e.spt, e.dst, dpt))
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany('INSERT INTO events VALUES '
+                                 '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 self._pending)
+        self._latest = max(self._latest, max(r[0] for r in self._pending))
+        self._pending = []
+
+    def query(self, src=None, dpt=None, since=None, until=None, limit=1000):
+        """Returns the latest matching events, oldest first
+
+        src may be an address or a network in CIDR notation. Raises
+        ValueError if it is invalid.
+        """
+        where = []
+        args = []
+        if src is not None:
+            lo, hi = get_addr_range(src)
+            where.append('src_key BETWEEN ? AND ?')
+            args.extend(('%032x' % (lo, ), '%032x' % (hi, )))
+        if dpt is not None:
+            where.append('dpt = ?')
+            args.append(int(dpt))
+        if since is not None:
+            where.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('time < ?')
+            args.append(until)
+        sql = 'SELECT %s FROM events' % (_COLUMNS, )
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time DESC LIMIT ?'
+        args.append(limit)
+        rows = self._db.execute(sql, args).fetchall()
+        rows.reverse()
+        return [Event._make(r[:8] + ('' if r[8] is None else str(r[8]), ))
+                for r in rows]
+
+    def compact(self, now=None):
+        if now is None:
+            now = time.time()
+        self.flush()
+        with self._db:
+            self._db.execute('DELETE FROM events WHERE time < ?',
+                             (now - self.retention, ))
+            self._db.execute('DELETE FROM events WHERE rowid IN '
+                             '(SELECT rowid FROM events ORDER BY time DESC '
+                             'LIMIT -1 OFFSET ?)', (self.max_events, ))
+        self._db.execute('PRAGMA incremental_vacuum')
+
+    def close(self):
+        self.flush()
+        self._db.close()
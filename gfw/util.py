@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import bisect
 import os.path
+import socket
 
 
 ANY_ADDR = '0.0.0.0/0'
@@ -55,19 +58,301 @@ def get_formatted_rule(rule):
     return r
 
 
-def get_connections(append):
-    with open('/proc/net/nf_conntrack', 'r') as f:
+def get_formatted_size(size):
+    """Format a number of bytes with a K, M, G or T suffix, like iptables
+    -L -v does without -x.
+    """
+    if size < 1024:
+        return '%d' % (size, )
+    for suffix in 'KMGT':
+        size /= 1024.0
+        if size < 1024:
+            break
+    return '%.1f%s' % (size, suffix)
+
+
+CONNTRACK = '/proc/net/nf_conntrack'
+CONNTRACK_CHUNK = 1 << 20
+FIB_TRIE = '/proc/net/fib_trie'
+IF_INET6 = '/proc/net/if_inet6'
+
+
+def pack_addr(addr):
+    """Returns an IPv4 or IPv6 address packed as by socket.inet_pton"""
+    if ':' in addr:
+        return socket.inet_pton(socket.AF_INET6, addr)
+    return socket.inet_aton(addr)
+
+
+def get_local_addresses(fib_trie=FIB_TRIE, if_inet6=IF_INET6):
+    """Returns the set of addresses of this host, packed by pack_addr
+
+    Files which are missing, e.g. without IPv6 support, are skipped.
+    """
+    addrs = set()
+    try:
+        with open(fib_trie, 'r') as f:
+            last = None
+            for line in f:
+                # An address is followed by its routes, e.g. '/32 host LOCAL'
+                fields = line.split()
+                if fields[:1] == ['|--']:
+                    last = fields[1]
+                elif fields[1:3] == ['host', 'LOCAL'] and last is not None:
+                    addrs.add(socket.inet_aton(last))
+    except IOError:
+        pass
+    try:
+        with open(if_inet6, 'r') as f:
+            for line in f:
+                addrs.add(binascii.unhexlify(line.split()[0]))
+    except IOError:
+        pass
+    return addrs
+
+_CONNTRACK_FAMILIES = frozenset(('ipv4', 'ipv6'))
+# Number of fields before the rest of a line, which are enough for the
+# family, protocol, state and the four keys below
+_CONNTRACK_SPLIT = 10
+# Keys of the original direction of a connection, whose values are returned
+_CONNTRACK_KEYS = ('src', 'dst', 'sport', 'dport')
+
+
+def _get_conntrack_fields(fields):
+    """Returns the values of the first of each of _CONNTRACK_KEYS in fields,
+    with '' for those which are missing
+    """
+    values = {}
+    for field in fields:
+        key, sep, value = field.partition('=')
+        if sep and key in _CONNTRACK_KEYS and key not in values:
+            values[key] = value
+    return tuple(values.get(key, '') for key in _CONNTRACK_KEYS)
+
+
+def get_connections(path=CONNTRACK, chunk_size=CONNTRACK_CHUNK):
+    """Yield the tracked connections as (proto, src, sport, dst, dport).
+
+    The addresses and ports are those of the original direction, i.e. the
+    first of each key on a line. TCP connections which are not established
+    are left out; those of all other protocols are included. Protocols
+    without ports (e.g. ICMP) have empty sport and dport. The file is read
+    in chunks of chunk_size bytes.
+    """
+    with open(path, 'rb', chunk_size) as f:
         for line in f:
-            line = line.split()
-            if line[2] != 'udp' and line[5] != 'ESTABLISHED':
+            # Only the fields up to the original direction are split
+            fields = line.split(None, _CONNTRACK_SPLIT)
+            if not fields:
                 continue
-            proto = line[2].upper()
-            s = 5
-            if line[2] == 'tcp':
-                s += 1
-            src = line[s].partition('=')[2]
-            dst = line[s + 1].partition('=')[2]
-            sport = line[s + 2].partition('=')[2]
-            dport = line[s + 3].partition('=')[2]
-            conn = (proto, src, sport, dst, dport)
-            append(conn)
+            # The family and its number are only in nf_conntrack
+            i = (2 if fields[0] in _CONNTRACK_FAMILIES else 0)
+            # Then the protocol, its number, the timeout and the state,
+            # which only some protocols have
+            proto = fields[i]
+            if proto == 'tcp':
+                if fields[i + 3] != 'ESTABLISHED':
+                    continue
+                i += 4
+            else:
+                i += 3
+            try:
+                src, dst, sport, dport = fields[i:i + 4]
+            except ValueError:
+                src = dst = ''
+            if src[:4] == 'src=' and dst[:4] == 'dst=':
+                src = src[4:]
+                dst = dst[4:]
+                if sport[:6] == 'sport=' and dport[:6] == 'dport=':
+                    sport = sport[6:]
+                    dport = dport[6:]
+                else:
+                    sport = dport = ''
+            else:
+                # Other fields (e.g. the timeouts of GRE) come first
+                src, dst, sport, dport = _get_conntrack_fields(line.split())
+                if not src or not dst:
+                    continue
+            yield (proto.upper(), src, sport, dst, dport)
+
+
+def diff_rows(old, new, key):
+    """Find the slice of rows which differ between old and new.
+
+    Rows are matched on key(row). Returns (start, old_end, new_end, order)
+    where old[start:old_end] has to be replaced by new[start:new_end]. If
+    the two slices only differ in the order of their rows, order maps each
+    new position to the old position of its row, otherwise it is None.
+    """
+    old_keys = [key(r) for r in old]
+    new_keys = [key(r) for r in new]
+    n_old = len(old_keys)
+    n_new = len(new_keys)
+    n = min(n_old, n_new)
+    start = 0
+    while start < n and old_keys[start] == new_keys[start]:
+        start += 1
+    end = 0
+    while end < n - start and old_keys[n_old - end - 1] == new_keys[n_new - end - 1]:
+        end += 1
+    old_end = n_old - end
+    new_end = n_new - end
+    order = None
+    if old_end - start > 1 and old_end - start == new_end - start:
+        old_slice = old_keys[start:old_end]
+        new_slice = new_keys[start:new_end]
+        if sorted(old_slice) == sorted(new_slice):
+            positions = {}
+            for i in xrange(old_end - 1, start - 1, -1):
+                positions.setdefault(old_keys[i], []).append(i)
+            order = range(start)
+            order.extend(positions[k].pop() for k in new_slice)
+            order.extend(xrange(old_end, n_old))
+    return (start, old_end, new_end, order)
+
+
+def sync_list_model(model, old, new, diff):
+    """Apply the result of diff_rows() to a list model.
+
+    old must mirror the current contents of model. Rows outside the changed
+    slice are only rewritten if any of their columns differ, so a single
+    insertion touches at most the rows whose numbering changed.
+    """
+    start, old_end, new_end, order = diff
+    if order is not None:
+        model.reorder(order)
+        current = [old[i] for i in order]
+    else:
+        # Rows in the common part of the slices are overwritten below
+        n = min(old_end, new_end)
+        for i in xrange(n, new_end):
+            model.insert(i, new[i])
+        for i in xrange(n, old_end):
+            model.remove(model.get_iter(n))
+        current = old[:n] + new[n:new_end] + old[old_end:]
+    for i, row in enumerate(new):
+        if current[i] != row:
+            model[i] = row
+
+
+def diff_order(old, new):
+    """Find the fewest changes which turn the list old into the list new.
+
+    The items of each list must be unique and hashable. Returns (removed,
+    added, moved) as sets of items: those only in old, those only in new,
+    and the fewest of the others which have to move for the rest to be in
+    the right order, i.e. those not in a longest common subsequence.
+    """
+    positions = dict((k, i) for i, k in enumerate(new))
+    common = [positions[k] for k in old if k in positions]
+    # Longest increasing subsequence of the new positions of the common
+    # items, in O(n log n): tails[i] is the smallest last position of the
+    # subsequences of length i + 1 found so far
+    tails = []
+    tail_indexes = []
+    prev = [None] * len(common)
+    for i, pos in enumerate(common):
+        j = bisect.bisect_left(tails, pos)
+        if j == len(tails):
+            tails.append(pos)
+            tail_indexes.append(i)
+        else:
+            tails[j] = pos
+            tail_indexes[j] = i
+        if j > 0:
+            prev[i] = tail_indexes[j - 1]
+    kept = set()
+    i = (tail_indexes[-1] if tail_indexes else None)
+    while i is not None:
+        kept.add(common[i])
+        i = prev[i]
+    removed = set(old).difference(positions)
+    added = set(new).difference(old)
+    moved = set(new[i] for i in common if i not in kept)
+    return (removed, added, moved)
+
+
+def diff_keys(iters, rows):
+    """Find the keys which were removed from or added to a keyed model.
+
+    iters maps the keys of the current rows to their iters and rows maps
+    the keys of the new rows to their values. Returns (removed, added).
+    """
+    return (set(iters).difference(rows), set(rows).difference(iters))
+
+
+def sync_keyed_model(model, iters, rows, diff, parent=None):
+    """Apply the result of diff_keys() to a tree model.
+
+    New rows are appended to the children of parent. iters is updated in
+    place. The iters of the model must persist across changes, as they do
+    for gtk.TreeStore.
+    """
+    removed, added = diff
+    for key in removed:
+        model.remove(iters.pop(key))
+    for key in added:
+        iters[key] = model.append(parent, rows[key])
+
+
+def parse_addr(addr):
+    """Parse an IPv4 or IPv6 address or network.
+
+    Returns (bits, network, prefix length) where bits is the size of the
+    address (32 or 128) and network is an integer with the host bits
+    cleared. Raises ValueError for invalid addresses.
+    """
+    addr, sep, prefix = addr.partition('/')
+    if ':' in addr:
+        family, bits = socket.AF_INET6, 128
+    else:
+        family, bits = socket.AF_INET, 32
+    try:
+        packed = socket.inet_pton(family, addr)
+        plen = (int(prefix) if sep else bits)
+    except (socket.error, ValueError):
+        raise ValueError('invalid address: %s' % (addr, ))
+    if not 0 <= plen <= bits:
+        raise ValueError('invalid prefix length: %s' % (prefix, ))
+    value = int(binascii.hexlify(packed), 16)
+    value &= ~((1 << (bits - plen)) - 1)
+    return (bits, value, plen)
+
+
+def get_addr_range(addr):
+    """Returns the first and last address of a network as IPv6 integers
+
+    IPv4 networks are mapped into ::ffff:0:0/96, so that both kinds of
+    addresses can be compared with each other.
+    """
+    bits, value, plen = parse_addr(addr)
+    if bits == 32:
+        value |= 0xffff << 32
+        plen += 96
+    return (value, value | ((1 << (128 - plen)) - 1))
+
+
+def parse_ports(ports):
+    """Parse e.g. '22', '80,443' or '6000:6007' into ports.
+
+    Returns a tuple of sorted (first, last) intervals, merged where they
+    overlap or touch. Raises ValueError for app names.
+    """
+    if ports == ANY_PORT:
+        return ((0, 65535), )
+    intervals = []
+    for p in ports.split(','):
+        first, sep, last = p.partition(':')
+        first = int(first)
+        last = (int(last) if sep else first)
+        if first > last:
+            raise ValueError('invalid port range: %s' % (p, ))
+        intervals.append((first, last))
+    intervals.sort()
+    merged = [intervals[0]]
+    for first, last in intervals[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return tuple(merged)
@@ -0,0 +1,108 @@
+#
+# worker.py: Background execution of backend operations
+#
+# Copyright (C) 2010  Darwin M. Bautista <djclue917@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import Queue
+import threading
+
+
+def _call(func, *args):
+    func(*args)
+
+
+class Worker(object):
+    """Runs functions on a background thread, one at a time and in order
+
+    Results are passed back through dispatch(func, *args), which has to
+    call func(*args) on the caller's thread, e.g. gobject.idle_add. submit()
+    must be called from that thread too. busy_handler, if given, is called
+    there with True when the first job is submitted and with False when the
+    last one is done.
+
+    Background jobs only run when no other jobs are queued, and do not
+    make the worker busy.
+    """
+
+    # Job priorities; lower ones run first
+    _FOREGROUND, _BACKGROUND, _STOP = range(3)
+
+    def __init__(self, dispatch=_call, busy_handler=None):
+        self._dispatch = dispatch
+        self._busy_handler = busy_handler
+        self._queue = Queue.PriorityQueue()
+        # Keeps jobs of the same priority in order
+        self._seq = itertools.count()
+        self.pending = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return self.pending > 0
+
+    def submit(self, func, args=(), callback=None, errback=None,
+               background=False):
+        """Queue func(*args)
+
+        callback is called with the result, or errback with the exception
+        if one was raised. Without an errback, the exception is raised again
+        on the caller's thread.
+        """
+        if background:
+            priority = self._BACKGROUND
+        else:
+            priority = self._FOREGROUND
+            self.pending += 1
+            if self.pending == 1 and self._busy_handler is not None:
+                self._busy_handler(True)
+        job = (func, args, callback, errback, background)
+        self._queue.put((priority, next(self._seq), job))
+
+    def stop(self):
+        """Finish the queued jobs and stop the thread"""
+        self._queue.put((self._STOP, next(self._seq), None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()[2]
+            if job is None:
+                break
+            func, args, callback, errback, background = job
+            try:
+                result = func(*args)
+            except Exception as e:
+                self._dispatch(self._done, errback, e, True, background)
+            else:
+                self._dispatch(self._done, callback, result, False, background)
+
+    def _done(self, handler, value, failed, background):
+        if not background:
+            self.pending -= 1
+        try:
+            if handler is not None:
+                handler(value)
+            elif failed:
+                raise value
+        finally:
+            if (not background and not self.pending and
+                    self._busy_handler is not None):
+                self._busy_handler(False)
+        # Remove the idle source
+        return False
@@ -24,7 +24,7 @@ setup(
     author_email='djclue917@gmail.com',
     url='http://code.google.com/p/ufw-frontends/',
     cmdclass={'install': Install},
-    scripts=['ufw-gtk'],
+    scripts=['ufw-gtk', 'ufw-cli'],
     packages=['gfw'],
     data_files=[
         ('share/ufw-frontends', ['share/ufw-gtk.ui', 'share/icon.png', 'share/logo.png']),